@@ -8,6 +8,7 @@ import logging
 from pathlib import Path
 
 from childes_processor.processor import PHONEMIZER_CONFIG_PATH, ChildesProcessor
+from childes_processor.chunked import ChunkedChildesProcessor
 from childes_processor.downloader import ChildesDownloader
 
 logger = logging.getLogger(__name__)
@@ -23,8 +24,13 @@ def process(args):
     """ 
     Processes a CHILDES CSV file or folder of CSV files, cleaning utterances, finding child and adult utterances, and phonemizing utterances.
     """
+
+    if args.chunk_size is not None or args.cache_dir is not None:
+        processor = ChunkedChildesProcessor(args.path, args.keep_child_utterances, args.max_age, args.chunk_size or 100_000, args.cache_dir)
+        processor.process(args.language, args.out_path, args.split, args.encoded)
+        return
     
-    processor = ChildesProcessor(args.path, args.keep_child_utterances, args.max_age)
+    processor = ChildesProcessor(args.path, args.keep_child_utterances, args.max_age, args.jobs if args.jobs is not None else 0)
     processor.phonemize_utterances(args.language)
     processor.character_split_utterances()
     processor.print_statistics()
@@ -33,6 +39,8 @@ def process(args):
         processor.save_splits(args.out_path)
     else:
         processor.save_df(args.out_path)
+    if args.encoded:
+        processor.save_encoded(args.out_path)
 
 def extract(args):
     """ Extracts utterances from a processed dataset. """
@@ -78,6 +86,10 @@ def main():
     parser_process.add_argument('-k', '--keep_child_utterances', action='store_true', help='Keep the child utterances in the dataset. Otherwise will only store adult utterances.')
     parser_process.add_argument('-m', '--max_age', default=None, type=int, help='Maximum age in months to include. If not provided, will include all ages.')
     parser_process.add_argument('-s', '--split', action='store_true', help='Produce three datasets according to a train-valid-test split of 90-5-5. Splitting is interleaved, not sequential.')
+    parser_process.add_argument('-e', '--encoded', action='store_true', help='Also save the phonemized utterances as an integer-encoded corpus in an "encoded" subdirectory of the output path.')
+    parser_process.add_argument('-j', '--jobs', default=None, type=int, help='Number of CSVs to read in parallel, when processing in memory. If not provided, will use one per CPU.')
+    parser_process.add_argument('-c', '--chunk_size', default=None, type=int, help='Process the CSVs this many rows at a time and merge the results at the end, so that memory use is bounded by the chunk size. If not provided, will process all utterances in memory at once.')
+    parser_process.add_argument('--cache_dir', default=None, type=Path, help='Directory in which to keep the processed output of each CSV, so that running again only processes CSVs that changed (implies chunked processing).')
     parser_process.set_defaults(func=process)
 
     parser_extract = subparsers.add_parser('extract', help='Takes a processed CSV and extracts a column, splitting child and adult utterances if desired.')
@@ -88,6 +100,9 @@ def main():
     parser_extract.set_defaults(func=extract)
 
     args = parser.parse_args()
+    if args.func == process and args.jobs is not None and (args.chunk_size is not None or args.cache_dir is not None):
+        # Chunked processing reads one CSV at a time
+        parser_process.error('-j/--jobs cannot be used with -c/--chunk_size or --cache_dir.')
     args.func(args)
 
 if __name__ == '__main__':
@@ -0,0 +1,337 @@
+""" Process CHILDES CSV files in chunks, without loading a whole collection into memory.
+
+Each chunk of rows is prepared, phonemized and sorted on its own, then written to a temporary CSV. The sorted chunks
+are then merged into the final dataset by streaming through them, so that memory use depends on the chunk size rather
+than on the size of the collection.
+
+If a cache directory is given, the sorted output of each input CSV is also kept there, with a manifest recording
+what each output was computed from: the contents of the CSV, the processing code and dictionaries, the phonemizer
+configuration and folding dictionaries of the language, and the filtering options. When a collection is processed
+again, only the CSVs whose key has changed are processed, and the cached outputs of the others are merged with them.
+"""
+
+import csv
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import tempfile
+from pathlib import Path
+
+from .dicts import col2dtype, punctuation_dict, string2w, w2string
+from .processor import PROCESSING_VERSION, ChildesProcessor, combine_statistics, csv_columns, load_phonemizer_config, log_statistics, read_csv
+from g2pp import get_session
+from src.corpus import save_encoded_corpus
+from src.folding import folding_hash
+from src.utils import file_hash
+
+# Maximum number of chunks to merge at once, to stay well below the limit on open files
+MAX_OPEN_FILES = 256
+
+MANIFEST_FILE = 'manifest.json'
+
+def _statistics_to_json(statistics):
+    """ Converts statistics returned by `ChildesProcessor.statistics` to a form that can be saved as JSON. """
+
+    if statistics is None:
+        return None
+    return {key: sorted(int(value) for value in values) if isinstance(values, set) else values for key, values in statistics.items()}
+
+def _statistics_from_json(statistics):
+    if statistics is None:
+        return None
+    return {key: set(values) if isinstance(values, list) else values for key, values in statistics.items()}
+
+def _read_rows(csv_path):
+    """ Yields the header and then each row of a CSV written by pandas, as lists of strings. """
+
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        yield from csv.reader(f)
+
+def _writer(f):
+    """ Returns a CSV writer that formats rows in the same way as `DataFrame.to_csv`. """
+    return csv.writer(f, lineterminator=os.linesep)
+
+def _sort_key(age, transcript_id):
+    """ The key that processed rows are sorted by, placing missing ages last as pandas does. """
+
+    age = float(age) if age != '' else math.nan
+    return (math.isnan(age), 0.0 if math.isnan(age) else age, int(transcript_id))
+
+def merge_sorted_csvs(csv_paths, out_file):
+    """ Merges CSVs with the same columns, each sorted by target_child_age and transcript_id, into a single sorted CSV.
+
+    Rows with the same age and transcript keep the order of the input files, so the result is the same as a stable
+    sort of the concatenated CSVs. Only one row of each input is held in memory at a time.
+
+    Returns:
+        int: The number of rows written.
+    """
+
+    readers = [_read_rows(csv_path) for csv_path in csv_paths]
+    headers = [next(reader) for reader in readers]
+    if any(header != headers[0] for header in headers):
+        raise ValueError('Cannot merge CSVs with different columns.')
+    age_column = headers[0].index('target_child_age')
+    transcript_column = headers[0].index('transcript_id')
+
+    num_rows = 0
+    with open(out_file, 'w', newline='', encoding='utf-8') as f:
+        writer = _writer(f)
+        writer.writerow(headers[0])
+        for row in heapq.merge(*readers, key=lambda row: _sort_key(row[age_column], row[transcript_column])):
+            writer.writerow(row)
+            num_rows += 1
+    return num_rows
+
+def merge_chunks(chunk_paths, out_file, tmp_dir, keep_chunks=False, max_open_files=MAX_OPEN_FILES):
+    """ Merges sorted chunk CSVs into out_file with `merge_sorted_csvs`. If there are more than max_open_files
+    chunks, consecutive groups of chunks are first merged into tmp_dir, which keeps ties in their original order.
+    The chunks are deleted once merged, unless keep_chunks is True.
+
+    Returns:
+        int: The number of rows written.
+    """
+
+    level = 0
+    while len(chunk_paths) > max_open_files:
+        merged_paths = []
+        for start in range(0, len(chunk_paths), max_open_files):
+            group = chunk_paths[start:start + max_open_files]
+            merged_path = Path(tmp_dir) / f'merged-{level}-{len(merged_paths):06d}.csv'
+            merge_sorted_csvs(group, merged_path)
+            if level > 0 or not keep_chunks:
+                for chunk_path in group:
+                    chunk_path.unlink()
+            merged_paths.append(merged_path)
+        chunk_paths = merged_paths
+        level += 1
+
+    num_rows = merge_sorted_csvs(chunk_paths, out_file)
+    if level > 0 or not keep_chunks:
+        for chunk_path in chunk_paths:
+            chunk_path.unlink()
+    return num_rows
+
+def split_csv(csv_path, out_path, num_rows, dev_size=10_000):
+    """ Splits a processed CSV into train.csv and valid.csv in the same way as `ChildesProcessor.split_df`, taking
+    every nth row for validation. """
+
+    interval = num_rows // dev_size
+    if interval == 0:
+        raise ValueError(f'Cannot take {dev_size} validation lines from a dataset of {num_rows} lines.')
+    rows = _read_rows(csv_path)
+    header = next(rows)
+    with open(out_path / 'train.csv', 'w', newline='', encoding='utf-8') as train_file, open(out_path / 'valid.csv', 'w', newline='', encoding='utf-8') as valid_file:
+        train, valid = _writer(train_file), _writer(valid_file)
+        train.writerow(header)
+        valid.writerow(header)
+        for i, row in enumerate(rows):
+            if i % interval == 0 and i // interval < dev_size:
+                valid.writerow(row)
+            else:
+                train.writerow(row)
+    return interval
+
+class ChunkedChildesProcessor:
+    """
+    Processes CHILDES CSV files one chunk at a time, giving the same output as `ChildesProcessor`.
+    """
+
+    def __init__(self, path: Path, keep_child_utterances: bool = True, max_age: int = None, chunk_size: int = 100_000, cache_dir: Path = None):
+        """
+        Args:
+            path (Path): Path to a CHILDES CSV file or folder of CHILDES CSV files.
+            keep_child_utterances (bool): Whether to keep child utterances.
+            max_age (int): Maximum age in months to include. If None, will include all ages.
+            chunk_size (int): Maximum number of rows to read from a CSV at a time.
+            cache_dir (Path): Directory in which to keep the output of each CSV, so that only CSVs that changed are
+                processed again. If None, nothing is cached.
+        """
+
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel(logging.INFO)
+
+        if not path.exists():
+            raise FileNotFoundError(f'Path {path} does not exist.')
+        self.csv_paths = sorted(path.glob('*.csv')) if path.is_dir() else [path]
+        self.keep_child_utterances = keep_child_utterances
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        # Write the input columns in the order of the first CSV, as `ChildesProcessor.load_data` does
+        self.columns = csv_columns(self.csv_paths[0]) if len(self.csv_paths) > 0 else []
+
+    def _process_file(self, csv_path: Path, file_index: int, language: str, chunk_dir: Path, keep_word_boundaries: bool):
+        """ Prepares, phonemizes and character splits each chunk of a CSV, writing it to a sorted CSV in chunk_dir.
+
+        Returns:
+            list of Path: The chunk CSVs, in the order of the input rows.
+            dict: The combined statistics of the chunks, as returned by `ChildesProcessor.statistics`, with the number
+                of rows read (input_lines) and of utterances that could not be phonemized (unphonemized_lines). None
+                if the CSV is empty.
+        """
+
+        chunk_paths = []
+        statistics = None
+        for chunk in read_csv(csv_path, chunk_size=self.chunk_size):
+            num_input_lines = len(chunk)
+            processor = ChildesProcessor.from_dataframe(chunk, self.keep_child_utterances, self.max_age)
+            if len(processor.df) == 0:
+                chunk_statistics = {'corpora': set(), 'speakers': set(), 'target_children': set(), 'lines': 0, 'words': 0, 'phonemes': 0, 'input_lines': num_input_lines, 'unphonemized_lines': 0}
+                statistics = chunk_statistics if statistics is None else combine_statistics(statistics, chunk_statistics)
+                continue
+            num_cleaned_lines = len(processor.df)
+            processor.phonemize_utterances(language, keep_word_boundaries)
+            processor.character_split_utterances()
+
+            # Write every chunk with the columns in the same order, so that they can be merged
+            columns = self.columns + [column for column in processor.df.columns if column not in self.columns]
+            chunk_path = chunk_dir / f'{file_index:06d}-{len(chunk_paths):06d}.csv'
+            processor.df[columns].to_csv(chunk_path)
+            chunk_paths.append(chunk_path)
+
+            chunk_statistics = processor.statistics()
+            chunk_statistics['input_lines'] = num_input_lines
+            chunk_statistics['unphonemized_lines'] = num_cleaned_lines - len(processor.df)
+            statistics = chunk_statistics if statistics is None else combine_statistics(statistics, chunk_statistics)
+            self.logger.info(f'Processed chunk {len(chunk_paths)} ({len(processor.df)} utterances) from {csv_path}.')
+
+        return chunk_paths, statistics
+
+    def cache_key(self, language: str, keep_word_boundaries: bool = True):
+        """ Returns a key identifying everything the processed output of a CSV depends on, other than its contents,
+        including the data files of the phonemizer (through `Wrapper.cache_namespace`) and the order of the columns. """
+
+        config = load_phonemizer_config(language)
+        wrapper = get_session(config['backend'], config['language'], keep_word_boundaries, **config.get('wrapper_kwargs', {})).wrapper
+        key = {
+            'processing_version': PROCESSING_VERSION,
+            'dicts': folding_hash(col2dtype, punctuation_dict, string2w, w2string),
+            'phonemizer_config': config,
+            'wrapper': wrapper.cache_namespace(),
+            'folding': folding_hash(*wrapper.folding_dicts()),
+            'keep_child_utterances': self.keep_child_utterances,
+            'max_age': self.max_age,
+            'keep_word_boundaries': keep_word_boundaries,
+            'columns': self.columns,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _load_manifest(self):
+        manifest_path = self.cache_dir / MANIFEST_FILE
+        if not manifest_path.exists():
+            return {}
+        with open(manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save_manifest(self, manifest):
+        # Write to a temporary file first so that an interrupted run never leaves a partially written manifest
+        tmp_path = self.cache_dir / (MANIFEST_FILE + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_path, self.cache_dir / MANIFEST_FILE)
+
+    def _cached_file(self, manifest, csv_path: Path, key: str):
+        """ Returns the manifest entry of a CSV if its output is cached under key, otherwise None. """
+
+        entry = manifest.get(str(csv_path.resolve()))
+        if entry is None or entry['key'] != key:
+            return None
+        if entry['output'] is not None and not (self.cache_dir / entry['output']).exists():
+            return None
+        return entry
+
+    def _cache_file(self, manifest, csv_path: Path, key: str, chunk_paths, statistics, chunk_dir: Path):
+        """ Merges the chunks of a CSV into a single sorted output in the cache directory and records it in the manifest. """
+
+        output = None
+        if len(chunk_paths) > 0:
+            output = f'{key[:32]}.csv'
+            tmp_path = self.cache_dir / (output + '.tmp')
+            merge_chunks(chunk_paths, tmp_path, chunk_dir)
+            os.replace(tmp_path, self.cache_dir / output)
+
+        name = str(csv_path.resolve())
+        previous = manifest.get(name)
+        manifest[name] = {'key': key, 'output': output, 'statistics': _statistics_to_json(statistics)}
+        # Remove the previous output of this CSV, unless another CSV has the same output
+        if previous is not None and previous['output'] not in (None, output) and all(entry['output'] != previous['output'] for entry in manifest.values()):
+            (self.cache_dir / previous['output']).unlink(missing_ok=True)
+        self._save_manifest(manifest)
+        return output
+
+    def _process_files(self, language: str, chunk_dir: Path, keep_word_boundaries: bool):
+        """ Processes each CSV, or reuses its cached output.
+
+        Returns:
+            list of Path: Sorted CSVs to merge, in the order of the input rows.
+            dict: The combined statistics of the CSVs.
+        """
+
+        sorted_paths = []
+        statistics = None
+        manifest = self._load_manifest() if self.cache_dir is not None else None
+        key = self.cache_key(language, keep_word_boundaries) if self.cache_dir is not None else None
+        num_reused = 0
+        for file_index, csv_path in enumerate(self.csv_paths):
+            if self.cache_dir is None:
+                chunk_paths, file_statistics = self._process_file(csv_path, file_index, language, chunk_dir, keep_word_boundaries)
+                sorted_paths.extend(chunk_paths)
+            else:
+                file_key = hashlib.sha256((key + file_hash(csv_path)).encode('utf-8')).hexdigest()
+                entry = self._cached_file(manifest, csv_path, file_key)
+                if entry is not None:
+                    self.logger.info(f'Reusing cached output for {csv_path}.')
+                    output, file_statistics = entry['output'], _statistics_from_json(entry['statistics'])
+                    num_reused += 1
+                else:
+                    chunk_paths, file_statistics = self._process_file(csv_path, file_index, language, chunk_dir, keep_word_boundaries)
+                    output = self._cache_file(manifest, csv_path, file_key, chunk_paths, file_statistics, chunk_dir)
+                if output is not None:
+                    sorted_paths.append(self.cache_dir / output)
+            if file_statistics is not None:
+                statistics = file_statistics if statistics is None else combine_statistics(statistics, file_statistics)
+
+        if len(sorted_paths) == 0:
+            raise ValueError(f'No utterances left to process in {len(self.csv_paths)} CSVs.')
+        if self.cache_dir is not None:
+            self.logger.info(f'Reused the cached outputs of {num_reused} of {len(self.csv_paths)} CSVs.')
+        log_statistics(self.logger, statistics)
+        return sorted_paths, statistics
+
+    def process(self, language: str, out_path: Path, split: bool = False, encoded: bool = False, keep_word_boundaries: bool = True):
+        """ Processes the CSVs and saves the dataset to out_path, as `processed.csv` or as `train.csv` and `valid.csv`
+        if split is True, and optionally as an integer-encoded corpus (see `ChildesProcessor.save_encoded`).
+
+        Returns:
+            dict: Statistics about the processed dataset, as returned by `ChildesProcessor.statistics`, with the
+                number of rows read from the CSVs (input_lines) and of utterances dropped because they could not be
+                phonemized (unphonemized_lines).
+        """
+
+        out_path.mkdir(exist_ok=True, parents=True)
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(exist_ok=True, parents=True)
+        # Keep the chunks next to the output, which is where there is known to be space for them
+        with tempfile.TemporaryDirectory(dir=out_path, prefix='.chunks-') as chunk_dir:
+            chunk_dir = Path(chunk_dir)
+            sorted_paths, statistics = self._process_files(language, chunk_dir, keep_word_boundaries)
+
+            merged_path = chunk_dir / 'processed.csv' if split else out_path / 'processed.csv'
+            num_rows = merge_chunks(sorted_paths, merged_path, chunk_dir, keep_chunks=self.cache_dir is not None)
+            self.logger.info(f'Merged {len(sorted_paths)} sorted CSVs into {merged_path} with a total of {num_rows} utterances.')
+
+            if encoded:
+                rows = _read_rows(merged_path)
+                phonemized_column = next(rows).index('phonemized_utterance')
+                save_encoded_corpus((row[phonemized_column] for row in rows), out_path / 'encoded')
+                self.logger.info(f'Saved encoded phonemized utterances to {out_path / "encoded"}')
+
+            if split:
+                interval = split_csv(merged_path, out_path, num_rows)
+                self.logger.info(f'Took every {interval}th line for validation. Saved train and valid sets to {out_path}')
+
+        return statistics
@@ -1,11 +1,11 @@
 col2dtype = {'id': int,
-             'speaker_role': str,
+             'speaker_role': 'category',
              'gloss': str,
              'stem': str,
-             'type': str,
+             'type': 'category',
              'num_tokens': int,
              'target_child_age': float,
-             'target_child_sex': str,
+             'target_child_sex': 'category',
              'transcript_id': int,
              'target_child_id': int,
              'speaker_id': int,
@@ -14,7 +14,7 @@ col2dtype = {'id': int,
              'part_of_speech': str,
              'num_morphemes': int,
              'num_tokens': int,
-             'language': str,}
+             'language': 'category',}
 
 punctuation_dict = {'imperative': '! ',
                     'imperative_emphatic': '! ',
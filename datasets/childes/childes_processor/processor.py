@@ -1,11 +1,13 @@
 """ Process CHILDES CSV files."""
 
+from concurrent.futures import ThreadPoolExecutor
 import json
 from pathlib import Path
 import pandas as pd
 import re 
 import logging
 import sys
+import time
 
 from .dicts import w2string, string2w, punctuation_dict, col2dtype
 
@@ -13,72 +15,165 @@ top_level_dir = Path(__file__).resolve().parents[3]
 sys.path.append(str(top_level_dir))
 
 from g2pp import character_split_utterances, phonemize_utterances
+from src.corpus import save_encoded_corpus
+from src.folding import get_folder
+from src.utils import resolve_njobs
 
 PHONEMIZER_CONFIG_PATH = Path(__file__).parent / 'phonemizer_config.json'
 
-def _clean_english(sentence, type):
-    """ Copied from AOChildes pipeline.py. Fixes spelling, punctuation, and word pairs for English CHILDES sentences. """
+# Version of the cleaning and processing steps. Increase it whenever a code change alters the processed output, so
+# that outputs cached by `ChunkedChildesProcessor` are rebuilt (edits to the dictionaries in dicts.py are detected
+# automatically).
+PROCESSING_VERSION = 2
+
+# Parse CSVs with pyarrow, which is multithreaded and much faster than the default parser. Fall back to the default
+# parser if it is not installed (this is logged by `ChildesProcessor.load_data`).
+try:
+    import pyarrow # noqa: F401
+    CSV_ENGINE = 'pyarrow'
+except ImportError:
+    CSV_ENGINE = 'c'
+
+def load_phonemizer_config(language):
+    """ Returns the entry of the phonemizer config for a language, giving the backend, the backend's language and
+    any wrapper_kwargs.
+
+    Raises:
+        ValueError: If the language is not in the phonemizer config.
+    """
 
-    sentence = str(sentence)
+    with open(PHONEMIZER_CONFIG_PATH, 'r') as f:
+        phonemizer_config = json.load(f)
+    language = language.lower()
+    if language not in phonemizer_config:
+        raise ValueError(f'Language "{language}" not found in phonemizer config. Choices: {list(phonemizer_config.keys())}')
+    return phonemizer_config[language]
+
+def csv_columns(csv_path):
+    """ Returns the columns in col2dtype (other than the id index) of a CHILDES CSV, in the order they appear in the file. """
+
+    header = pd.read_csv(csv_path, nrows=0).columns
+    return [column for column in header if column in col2dtype and column != 'id']
+
+def read_csv(csv_path, chunk_size=None):
+    """ Reads the columns in col2dtype from a CHILDES CSV, in the order they appear in the file. If chunk_size is
+    given, returns an iterator over DataFrames of at most chunk_size rows instead. """
+
+    if chunk_size is not None:
+        # The pyarrow parser cannot read a file in chunks
+        return pd.read_csv(csv_path, index_col='id', usecols=col2dtype.keys(), dtype=col2dtype, chunksize=chunk_size)
+    df = pd.read_csv(csv_path, index_col='id', usecols=col2dtype.keys(), dtype=col2dtype, engine=CSV_ENGINE)
+    # The pyarrow parser orders the columns as in usecols rather than as in the file
+    return df[csv_columns(csv_path)]
+
+def _concat_csvs(dfs):
+    """ Concatenates DataFrames read by `read_csv`, first giving each categorical column the same categories in every
+    DataFrame so that they stay categorical (pandas falls back to object columns when the categories differ). """
+
+    for column, dtype in col2dtype.items():
+        if dtype != 'category':
+            continue
+        categories = sorted(set().union(*(df[column].cat.categories for df in dfs)))
+        for df in dfs:
+            df[column] = df[column].cat.set_categories(categories)
+    return pd.concat(dfs)
+
+def _peak_memory_mb():
+    """ Returns the peak resident memory of this process so far in MB, or None if it cannot be measured on this platform. """
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+def combine_statistics(a, b):
+    """ Combines the statistics of two DataFrames, as returned by `ChildesProcessor.statistics`. """
+    return {key: a[key] | b[key] if isinstance(a[key], set) else a[key] + b[key] for key in a}
+
+def log_statistics(logger, statistics):
+    """ Logs statistics about a processed DataFrame, as returned by `ChildesProcessor.statistics`. """
+
+    logger.info(f'Total corpora: {len(statistics["corpora"])}')
+    logger.info(f'Total speakers: {len(statistics["speakers"])}')
+    logger.info(f'Total target children: {len(statistics["target_children"])}')
+    logger.info(f'Total lines: {statistics["lines"]}')
+    logger.info(f'Total words: {statistics["words"]}')
+    logger.info(f'Total phonemes: {statistics["phonemes"]}')
+
+# Sentences that are always marked as questions in English
+QUESTION_START = re.compile(r'(?:what(?! a )|where|how|who|when|you wanna|do you|can you)')
+
+# Matches any key of w2string as a whole (whitespace-separated) word, longest keys first
+W2STRING_PATTERN = re.compile(r'(?<!\S)(?:' + '|'.join(re.escape(w) for w in sorted(w2string, key=len, reverse=True) if w.split() == [w]) + r')(?!\S)')
+
+def _as_python_strings(sentences):
+    """ Converts each value to a Python string (as `str` would), in an object Series so that pandas string methods
+    follow Python's rules for lowercasing and whitespace rather than those of pyarrow. """
+    return pd.Series([str(sentence) for sentence in sentences], index=sentences.index, dtype=object)
+
+def _split_words(sentences, fix_spelling=False):
+    """ Lowercases each sentence, separates words with single spaces and splits compounds. If `fix_spelling` is True,
+    words found in w2string are first replaced with their corrected spelling. """
+
+    sentences = sentences.str.lower().str.replace(r'\s+', ' ', regex=True).str.strip()
+    if fix_spelling:
+        sentences = sentences.str.replace(W2STRING_PATTERN, lambda match: w2string[match.group()], regex=True)
+    return sentences.str.replace('+', ' ', regex=False).str.replace('_', ' ', regex=False)
+
+def _clean_english(sentences, types):
+    """ Adapted from AOChildes pipeline.py. Fixes spelling, punctuation, and word pairs for English CHILDES sentences.
+
+    Args:
+        sentences (pd.Series): The sentences to clean.
+        types (pd.Series): The utterance type of each sentence, used to choose its punctuation.
+    """
 
-    # Fix word pairs 
-    for string in string2w:
-        if string in sentence:
-            sentence = sentence.replace(string, string2w[string])
+    # Fix word pairs
+    sentences = pd.Series(get_folder(string2w).fold_lines([str(sentence) for sentence in sentences]), index=sentences.index, dtype=object)
 
     # consistent question marking
-    if (sentence.startswith('what') and not sentence.startswith('what a ')) or \
-            sentence.startswith('where') or \
-            sentence.startswith('how') or \
-            sentence.startswith('who') or \
-            sentence.startswith('when') or \
-            sentence.startswith('you wanna') or \
-            sentence.startswith('do you') or \
-            sentence.startswith('can you'):
-        sentence += '?'
-    else:
-        sentence += f'{punctuation_dict[type]}' if type in punctuation_dict else '.'
-
-    words = []
-    for w in str(sentence).split():
-        w = w.lower()
-        # fix spelling
-        if w in w2string:
-            w = w2string[w.lower()]
-        # split compounds
-        w = w.replace('+', ' ').replace('_', ' ')
-        words.append(w)
-    
-    return ' '.join(words)
-
-def _clean(sentence, type):
-    """ Process a CHILDES sentence. Lowercase, add punctuation and split compounds."""
-
-    sentence = str(sentence)
-    if not type in punctuation_dict:
-        sentence += '. '
-    else:
-        sentence += f' {punctuation_dict[type]}'
-    words = []
-    for w in str(sentence).split():
-        w = w.lower()
-        # split compounds
-        w = w.replace('+', ' ').replace('_', ' ')
-        words.append(w)
-    return ' '.join(words)
+    punctuation = types.map(punctuation_dict).astype(object).fillna('.')
+    punctuation = punctuation.where(~sentences.str.match(QUESTION_START), '?')
+
+    return _split_words(sentences + punctuation, fix_spelling=True)
+
+def _clean(sentences, types):
+    """ Process CHILDES sentences. Lowercase, add punctuation and split compounds."""
+
+    punctuation = (' ' + types.map(punctuation_dict).astype(object)).fillna('. ')
+    return _split_words(_as_python_strings(sentences) + punctuation)
 
 class ChildesProcessor:
     """
     Processes CHILDES CSV files.
     """
     
-    def __init__(self, path: Path, keep_child_utterances: bool = True, max_age: int = None):
+    def __init__(self, path: Path, keep_child_utterances: bool = True, max_age: int = None, njobs: int = 0):
 
         self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
 
-        self.df = self.load_data(path)
-    
+        self.df = self.load_data(path, njobs)
+        self.filter_utterances(keep_child_utterances, max_age)
+
+    @classmethod
+    def from_dataframe(cls, df: pd.DataFrame, keep_child_utterances: bool = True, max_age: int = None):
+        """ Creates a processor from rows already read from CHILDES CSVs with `read_csv`, such as one chunk of a
+        larger collection, preparing them in the same way as `load_data`. """
+
+        processor = cls.__new__(cls)
+        processor.logger = logging.getLogger(__name__)
+        processor.logger.setLevel(logging.INFO)
+        processor.df = processor.prepare_data(df)
+        processor.filter_utterances(keep_child_utterances, max_age)
+        return processor
+
+    def filter_utterances(self, keep_child_utterances: bool = True, max_age: int = None):
+        """ Removes utterances above the maximum age and, unless keep_child_utterances is True, child utterances. """
+
         if max_age is not None:
             num_above_max = len(self.df[self.df['target_child_age'] > max_age])
             self.df = self.df[self.df['target_child_age'] <= max_age]
@@ -88,20 +183,19 @@ class ChildesProcessor:
             num_child = len(self.df[self.df['is_child']])
             self.df = self.df[~self.df['is_child']]
             self.logger.info(f'Removed {num_child} child utterances. Now have {len(self.df)} adult utterances.')
-    
-    def load_data(self, path: Path):
+
+    def load_data(self, path: Path, njobs: int = 0):
         """ Given a path to a CHILDES CSV file, or a folder of CHILDES CSV files, prepare the data for training, returning a DataFrame.
         
-        Carries out the following:
-        1. Keep only the columns specified in col2dtype.
-        2. Remove rows with negative number of tokens or no tokens.
-        3. Add a column 'is_child' to indicate whether the speaker is a child.
-        4. Sort the DataFrame by target_child_age and transcript_id.
-        5. Remove rows that have nonsense words.
-        6. Clean each sentence with some simple preprocessing (fixing spelling if in English).
+        Keeps only the columns specified in col2dtype, then prepares the rows with `prepare_data`.
+
+        The CSVs are read in parallel, with low-cardinality string columns (such as speaker_role and type) stored
+        as categoricals. The number of rows read per second, the peak memory use and the parser used are reported
+        in `self.load_stats`.
 
         Args:
             path (Path): Path to a CHILDES CSV file or folder of CHILDES CSV files.
+            njobs (int): Number of CSVs to read at the same time. If below 1, one per CPU.
         
         """
 
@@ -109,19 +203,46 @@ class ChildesProcessor:
             raise FileNotFoundError(f'Path {path} does not exist.')
         if path.is_dir():
             self.logger.info('Path is a directory, will extract utterances from all CSVs found in this directory.')
-            transcripts = path
+            csv_paths = sorted(path.glob('*.csv'))
         else:
             self.logger.info('Path is a file, will extract utterances from this CSV.')
-            transcripts = [path]
+            csv_paths = [path]
+
+        # Load each utterance as a row in original CSV and remove empty rows.
+        # Threads are enough to read CSVs in parallel, since the parsers do most of their work without holding the GIL.
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(resolve_njobs(njobs), max(len(csv_paths), 1))) as executor:
+            dfs = list(executor.map(read_csv, csv_paths))
+        df = _concat_csvs(dfs)
+        num_rows = len(df)
+        load_time = time.perf_counter() - start_time
+        self.load_stats = {'rows': num_rows, 'seconds': load_time, 'rows_per_second': num_rows / load_time if load_time > 0 else float('inf'), 'peak_memory_mb': _peak_memory_mb(), 'engine': CSV_ENGINE}
+        peak_memory = f', peak memory {self.load_stats["peak_memory_mb"]:.0f} MB' if self.load_stats['peak_memory_mb'] is not None else ''
+        self.logger.info(f'Read {num_rows} rows from {len(dfs)} CSVs in {load_time:.2f}s ({self.load_stats["rows_per_second"]:.0f} rows/s{peak_memory}) using the {CSV_ENGINE} parser.')
+        if CSV_ENGINE != 'pyarrow':
+            self.logger.warning('pyarrow is not installed, so the CSVs were read with the slower C parser. Install pyarrow (see requirements.txt) to read them faster.')
+
+        return self.prepare_data(df)
+
+    def prepare_data(self, df: pd.DataFrame):
+        """ Prepares rows read from CHILDES CSVs for training, returning a DataFrame.
+
+        Carries out the following:
+        1. Remove rows with negative number of tokens or no tokens.
+        2. Add a column 'is_child' to indicate whether the speaker is a child.
+        3. Sort the DataFrame by target_child_age and transcript_id.
+        4. Remove rows that have nonsense words.
+        5. Clean each sentence with some simple preprocessing (fixing spelling if in English).
+
+        Args:
+            df (pd.DataFrame): Rows read from CHILDES CSVs with `read_csv`. Modified in place.
+        """
 
-        # Load each utterance as a row in original CSV and remove empty rows
-        dfs = [pd.read_csv(csv_path, index_col='id', usecols=col2dtype.keys(), dtype=col2dtype) for csv_path in sorted(transcripts.glob('*.csv'))]
-        df = pd.concat(dfs)
         df.drop(df[df['num_tokens'] <= 0].index, inplace=True)
-        self.logger.info(f'Loaded {len(df)} utterances from {len(dfs)} CSVs.')
+        self.logger.info(f'Loaded {len(df)} utterances.')
         
         # Add a column to indicate whether the speaker is a child
-        roles = df['speaker_role'].unique()
+        roles = df['speaker_role'].unique().tolist()
         child_roles = ['Target_Child', 'Child']
         self.logger.info(f'Found speaker roles: {roles}')
         df['is_child'] = df['speaker_role'].isin(child_roles)
@@ -130,17 +251,18 @@ class ChildesProcessor:
         df.sort_values(by=['target_child_age', 'transcript_id'], inplace=True)
 
         # Remove rows with ignore_regex in gloss
-        ignore_regex = re.compile(r'(�|www|xxx|yyy)')
-        df.drop(df[df['gloss'].apply(lambda x: ignore_regex.findall(str(x)) != [])].index, inplace=True)
+        ignore_regex = re.compile(r'(?:�|www|xxx|yyy)')
+        df.drop(df[df['gloss'].str.contains(ignore_regex, na=False)].index, inplace=True)
         
         # Drop null gloss
         df.dropna(subset=['gloss'], inplace=True)
 
         # Clean each sentence, special cleaning for English
-        if df['language'].iloc[0] == 'eng':
-            df['processed_gloss'] = df.apply(lambda x: _clean_english(x['gloss'], x['type']), axis=1)
+        language = df['language'].iloc[0] if len(df) > 0 else None
+        if language == 'eng':
+            df['processed_gloss'] = _clean_english(df['gloss'], df['type'])
         else:
-            df['processed_gloss'] = df.apply(lambda x: _clean(x['gloss'], x['type']), axis=1)
+            df['processed_gloss'] = _clean(df['gloss'], df['type'])
 
         # Fix some data types
         df['part_of_speech'] = df['part_of_speech'].astype(str)
@@ -151,7 +273,7 @@ class ChildesProcessor:
         df['target_child_sex'] = df['target_child_sex'].apply(lambda x: 'unknown' if x == 'nan' else x)
 
         # Fix transcription errors in Serbian
-        if df['language'].iloc[0] == 'srp':
+        if language == 'srp':
             df.drop(df[df['processed_gloss'].str.contains('q')].index, inplace=True)
 
         return df
@@ -159,12 +281,7 @@ class ChildesProcessor:
     def phonemize_utterances(self, language: str, keep_word_boundaries: bool = True, verbose: bool = False):
         """ Phonemize utterances. """
 
-        with open(PHONEMIZER_CONFIG_PATH, 'r') as f:
-            phonemizer_config = json.load(f)
-        language = language.lower()
-        if language not in phonemizer_config:
-            raise ValueError(f'Language "{language}" not found in phonemizer config. Choices: {list(phonemizer_config.keys())}')
-        config = phonemizer_config[language]
+        config = load_phonemizer_config(language)
         self.logger.info(f'Using phonemizer config: {config}')
 
         backend = config['backend']
@@ -207,22 +324,25 @@ class ChildesProcessor:
             train = self.df.drop(valid.index)
         return train, valid
 
-    def print_statistics(self):
-        """ Print statistics about the DataFrame. """
+    def statistics(self):
+        """ Returns the sets of corpora, speakers and target children in the DataFrame, and its number of lines,
+        words and phonemes. Statistics of separate DataFrames can be combined with `combine_statistics`. """
 
-        total_corpora = len(self.df['corpus_id'].unique())
-        total_speakers = len(self.df['speaker_id'].unique())
-        total_target_children = len(self.df['target_child_id'].unique())
-        total_lines = len(self.df)
         num_words = sum([line.count('WORD_BOUNDARY') for line in self.df['phonemized_utterance']])
         num_phonemes = sum([len(line.split()) for line in self.df['phonemized_utterance']]) - num_words
+        return {
+            'corpora': set(self.df['corpus_id'].unique()),
+            'speakers': set(self.df['speaker_id'].unique()),
+            'target_children': set(self.df['target_child_id'].unique()),
+            'lines': len(self.df),
+            'words': num_words,
+            'phonemes': num_phonemes,
+        }
+
+    def print_statistics(self):
+        """ Print statistics about the DataFrame. """
 
-        self.logger.info(f'Total corpora: {total_corpora}')
-        self.logger.info(f'Total speakers: {total_speakers}')
-        self.logger.info(f'Total target children: {total_target_children}')
-        self.logger.info(f'Total lines: {total_lines}')
-        self.logger.info(f'Total words: {num_words}')
-        self.logger.info(f'Total phonemes: {num_phonemes}')
+        log_statistics(self.logger, self.statistics())
 
     def save_df(self, out_path: Path):
         """ Save the DataFrame to a CSV file. """
@@ -231,6 +351,12 @@ class ChildesProcessor:
         self.df.to_csv(out_path / 'processed.csv')
         self.logger.info(f'Saved processed dataset to {out_path / "processed.csv"} with a total of {len(self.df)} utterances.')
 
+    def save_encoded(self, out_path: Path):
+        """ Save the phonemized utterances as an integer-encoded corpus, in the same order as the DataFrame. """
+
+        save_encoded_corpus(self.df['phonemized_utterance'], out_path / 'encoded')
+        self.logger.info(f'Saved encoded phonemized utterances to {out_path / "encoded"}')
+
     def save_splits(self, out_path: Path):
         """ Save the training and validation DataFrames to CSV files. """
 
@@ -0,0 +1,88 @@
+""" Run jobs, such as processing each CHILDES language, concurrently in separate processes.
+
+Each job declares how many CPU cores it keeps busy (for instance, the number of espeak workers of its phonemizer
+backend). Jobs are started largest first, as long as the cores they need are free, so that the longest jobs do not
+end up running alone at the end. Each job runs in its own process, so a job that fails, or even crashes its process,
+does not affect the others. Job processes are spawned rather than forked, since they start their own pools of
+workers and forking a process that runs threads can leave those workers waiting on locks that are never released.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import logging
+import multiprocessing
+import time
+import traceback
+
+from .processor import load_phonemizer_config
+from g2pp import get_wrapper_class
+from src.utils import resolve_njobs
+
+logger = logging.getLogger(__name__)
+
+def backend_cores(language):
+    """ Returns the number of CPU cores used to phonemize a language, according to the phonemizer config: the
+    `njobs` of its wrapper, or 1 for backends that run in a single process. """
+
+    config = load_phonemizer_config(language)
+    wrapper_class = get_wrapper_class(config['backend'])
+    njobs = config.get('wrapper_kwargs', {}).get('njobs', wrapper_class.WRAPPER_KWARGS_DEFAULTS.get('njobs', 1))
+    return resolve_njobs(njobs)
+
+def _run_job(function, args):
+    """ Runs a job in a worker process, returning its result and wall time, or the error it raised. """
+
+    start_time = time.perf_counter()
+    try:
+        result = function(*args)
+    except Exception:
+        return {'status': 'failed', 'seconds': time.perf_counter() - start_time, 'error': traceback.format_exc()}
+    return {'status': 'done', 'seconds': time.perf_counter() - start_time, 'result': result}
+
+def run_jobs(jobs, max_cores=0):
+    """ Runs jobs concurrently, each in its own process, without using more than max_cores cores at once.
+
+    Args:
+        jobs (list of dict): The jobs to run. Each has a `name`, a `function` (which the spawned process must be able
+            to import) and its `args` (which must be picklable), the number of `cores` it uses and its `size`, an
+            estimate of how long it runs used to start the largest jobs first. A job that needs more than max_cores cores is run once no other job is running.
+        max_cores (int): Number of cores to use. If below 1, all of them.
+
+    Returns:
+        list of dict: For each job, in the order given, its `name`, its `status` ('done' or 'failed'), its wall time in
+        `seconds` and either the `result` returned by its function or the `error` that it raised.
+    """
+
+    max_cores = resolve_njobs(max_cores)
+    context = multiprocessing.get_context('spawn')
+    pending = sorted(range(len(jobs)), key=lambda i: jobs[i]['size'], reverse=True)
+    running = {}
+    results = [None] * len(jobs)
+    free_cores = max_cores
+    while len(pending) > 0 or len(running) > 0:
+        # Start every pending job that fits in the free cores, largest first
+        for i in list(pending):
+            cores = min(jobs[i]['cores'], max_cores)
+            if cores <= free_cores or len(running) == 0:
+                logger.info(f'Starting {jobs[i]["name"]} on {cores} cores.')
+                executor = ProcessPoolExecutor(max_workers=1, mp_context=context)
+                future = executor.submit(_run_job, jobs[i]['function'], jobs[i]['args'])
+                running[future] = (i, cores, executor, time.perf_counter())
+                free_cores -= cores
+                pending.remove(i)
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            i, cores, executor, start_time = running.pop(future)
+            executor.shutdown(wait=False)
+            free_cores += cores
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # The worker process itself died, e.g. killed for running out of memory
+                results[i] = {'status': 'failed', 'seconds': time.perf_counter() - start_time, 'error': repr(e)}
+            results[i]['name'] = jobs[i]['name']
+            if results[i]['status'] == 'done':
+                logger.info(f'Finished {jobs[i]["name"]} in {results[i]["seconds"]:.1f}s.')
+            else:
+                logger.error(f'{jobs[i]["name"]} failed after {results[i]["seconds"]:.1f}s:\n{results[i]["error"]}')
+    return results
@@ -1,155 +1,217 @@
 import sys
 import os
+import json
+import logging
 import shutil
 
 from pathlib import Path
 sys.path.append('./')
-from childes_processor.processor import ChildesProcessor
+from childes_processor.chunked import ChunkedChildesProcessor
 from childes_processor.downloader import ChildesDownloader
+from childes_processor.scheduler import backend_cores, run_jobs
 
 SKIP_DOWNLOAD = True
 KEEP_CHILD_UTTERANCES = True
 DOWNLOAD_OUT_PATH = Path('downloaded')
 PROCESS_OUT_PATH = Path('CHILDES-dataset')
+# Processed output of each downloaded CSV, reused when neither the CSV nor the processing has changed
+CACHE_PATH = Path('processed-cache')
 MAX_AGE = None
+# Number of cores to share between the languages processed at the same time (0 for all of them)
+MAX_CORES = 0
+SUMMARY_PATH = PROCESS_OUT_PATH / 'run_summary.json'
 
-downloader = ChildesDownloader()
+# Collection, corpora and name of each language
+LANGUAGES = [
+    # Basque
+    ("Other", ["Luque", "Soto"], "Basque"),
 
-def download_and_process_corpora(collection, corpora, language):
-    if not SKIP_DOWNLOAD:   
-        for corpus in corpora:
-            print(f"\n----------\nDOWNLOADING: Corpus: {corpus} in Collection: {collection} for Language: {language}\n----------\n")
-            downloader.download(collection, corpus,
-                                DOWNLOAD_OUT_PATH,
-                                separate_by_child=False)
+    # Cantonese
+    ("Chinese", ["HKU", "LeeWongLeung", "PaidoCantonese"], "Cantonese"),
 
-        if language != collection:
-            if (DOWNLOAD_OUT_PATH / language).exists():
-                shutil.rmtree(DOWNLOAD_OUT_PATH / language)
-            os.rename(DOWNLOAD_OUT_PATH / collection, DOWNLOAD_OUT_PATH / language)
-    
-    if language == "Eng-NA":
-        phonemize_language = "EnglishNA"
-    elif language == "Eng-UK":
-        phonemize_language = "EnglishUK"
-    else:
-        phonemize_language = language
-    
-    processor = ChildesProcessor(DOWNLOAD_OUT_PATH / language,
-                                 keep_child_utterances=KEEP_CHILD_UTTERANCES,
-                                 max_age = MAX_AGE)
-    
-    processor.phonemize_utterances(phonemize_language)
-    processor.character_split_utterances()
-    processor.print_statistics()
+    # Catalan
+    ("Romance", ["EstevePrieto", "GRERLI", "Jordina", "Julia", "MireiaEvaPascual", "SerraSole"], "Catalan"),
 
-    processor.save_df(PROCESS_OUT_PATH / language)
+    # Croatian
+    ("Slavic", ["Kovacevic"], "Croatian"),
 
-# Basque
-download_and_process_corpora("Other", ["Luque", "Soto"], "Basque")
+    # Danish
+    ("Scandinavian", ["Plunkett"], "Danish"),
 
-# Cantonese
-download_and_process_corpora("Chinese", ["HKU", "LeeWongLeung", "PaidoCantonese"], "Cantonese")
+    # Dutch
+    ("DutchAfrikaans", ["Utrecht", "Gillis", "Schaerlaekens", "Groningen", "Schlichting", "VanKampen", "DeHouwer", "Zink"], "Dutch"),
 
-# Catalan
-download_and_process_corpora("Romance", ["EstevePrieto", "GRERLI", "Jordina", "Julia", "MireiaEvaPascual", "SerraSole"], "Catalan")
+    # English (US)
+    ("Eng-NA", ["Bates", "Bernstein", "Bliss", "Bloom", "Bohannon", "Braunwald", "Brent", "Brown", "Clark", "ComptonPater", "Davis", "Demetras1", "Demetras2", "Feldman", "Garvey", "Gathercole", "Gelman", "Gleason", "Goad", "HSLLD", "Haggerty", "Hall", "Higginson", "Inkelas", "Kuczaj", "MacWhinney", "McCune", "McMillan", "Menn", "Morisset", "Nelson", "NewEngland", "NewmanRatner", "Nippold", "Peters", "Post", "Providence", "Rollins", "Sachs", "Sawyer", "Snow", "Soderstrom", "Sprott", "StanfordEnglish", "Suppes", "Tardif", "Valian", "VanHouten", "VanKleeck", "Warren", "Weist"], "Eng-NA"),
 
-# Croatian
-download_and_process_corpora("Slavic", ["Kovacevic"], "Croatian")
+    # English (UK)
+    ("Eng-UK", ["Belfast", "Conti1", "Cruttenden", "Edinburgh", "Fletcher", "Forrester", "Gathburn", "Howe", "KellyQuigley", "Korman", "Lara", "MPI-EVA-Manchester", "Manchester", "Nuffield", "Sekali", "Smith", "Thomas", "Tommerdahl", "Wells"], "Eng-UK"),
 
-# Danish
-download_and_process_corpora("Scandinavian", ["Plunkett"], "Danish")
+    # Estonian
+    ("Other", ["Argus", "Beek", "Kapanen", "Kohler", "Korgesaar", "Kuett", "Kutt", "MAIN", "Vija", "Zupping"], "Estonian"),
 
-# Dutch
-download_and_process_corpora("DutchAfrikaans", ["Utrecht", "Gillis", "Schaerlaekens", "Groningen", "Schlichting", "VanKampen", "DeHouwer", "Zink"], "Dutch")
+    # Farsi
+    ("Other", ["Family", "Samadi"], "Farsi"),
 
-# English (US)
-download_and_process_corpora("Eng-NA", ["Bates", "Bernstein", "Bliss", "Bloom", "Bohannon", "Braunwald", "Brent", "Brown", "Clark", "ComptonPater", "Davis", "Demetras1", "Demetras2", "Feldman", "Garvey", "Gathercole", "Gelman", "Gleason", "Goad", "HSLLD", "Haggerty", "Hall", "Higginson", "Inkelas", "Kuczaj", "MacWhinney", "McCune", "McMillan", "Menn", "Morisset", "Nelson", "NewEngland", "NewmanRatner", "Nippold", "Peters", "Post", "Providence", "Rollins", "Sachs", "Sawyer", "Snow", "Soderstrom", "Sprott", "StanfordEnglish", "Suppes", "Tardif", "Valian", "VanHouten", "VanKleeck", "Warren", "Weist"], "Eng-NA")
+    # French
+    ("French", ["Champaud", "Geneva", "GoadRose", "Hammelrath", "Hunkeler", "KernFrench", "Leveillé", "Lyon", "MTLN", "Palasis", "Paris", "Pauline", "StanfordFrench", "VionColas", "Yamaguchi", "York"], "French"),
 
-# English (UK)
-download_and_process_corpora("Eng-UK", ["Belfast", "Conti1", "Cruttenden", "Edinburgh", "Fletcher", "Forrester", "Gathburn", "Howe", "KellyQuigley", "Korman", "Lara", "MPI-EVA-Manchester", "Manchester", "Nuffield", "Sekali", "Smith", "Thomas", "Tommerdahl", "Wells"], "Eng-UK")
+    # German
+    ("German", ["Caroline", "Grimm", "Leo", "Manuela", "Miller", "Rigol", "Stuttgart", "Szagun", "Wagner", "Weissenborn"], "German"),
 
-# Estonian
-download_and_process_corpora("Other", ["Argus", "Beek", "Kapanen", "Kohler", "Korgesaar", "Kuett", "Kutt", "MAIN", "Vija", "Zupping"], "Estonian")
+    # Greek
+    # ("Other", ["Doukas", "PaidoGreek", "Stephany"], "Greek"),
+    # print("WARNING: Greek phonemization is not supported. Skipping phonemization for Greek.")
 
-# Farsi
-download_and_process_corpora("Other", ["Family", "Samadi"], "Farsi")
+    # Hebrew
+    # ("Other", ["BatEl", "BermanLong", "BSF", "Levy", "Naama", "Ravid"], "Hebrew"),
+    # print("WARNING: Hebrew phonemization is not supported. Skipping phonemization for Hebrew.")
 
-# French
-download_and_process_corpora("French", ["Champaud", "Geneva", "GoadRose", "Hammelrath", "Hunkeler", "KernFrench", "Leveillé", "Lyon", "MTLN", "Palasis", "Paris", "Pauline", "StanfordFrench", "VionColas", "Yamaguchi", "York"], "French")
+    # Hungarian
+    ("Other", ["Bodor", "MacWhinney", "Reger"], "Hungarian"),
 
-# German
-download_and_process_corpora("German", ["Caroline", "Grimm", "Leo", "Manuela", "Miller", "Rigol", "Stuttgart", "Szagun", "Wagner", "Weissenborn"], "German")
+    # Icelandic
+    ("Scandinavian", ["Einarsdottir", "Kari"], "Icelandic"),
 
-# Greek
-# download_and_process_corpora("Other", ["Doukas", "PaidoGreek", "Stephany"], "Greek")
-# print("WARNING: Greek phonemization is not supported. Skipping phonemization for Greek.")
+    # Indonesian
+    ("EastAsian", ["Jakarta"], "Indonesian"),
 
-# Hebrew
-# download_and_process_corpora("Other", ["BatEl", "BermanLong", "BSF", "Levy", "Naama", "Ravid"], "Hebrew")
-# print("WARNING: Hebrew phonemization is not supported. Skipping phonemization for Hebrew.")
+    # Irish
+    ("Celtic", ["Gaeltacht", "Guilfoyle"], "Irish"),
 
-# Hungarian
-download_and_process_corpora("Other", ["Bodor", "MacWhinney", "Reger"], "Hungarian")
+    # Italian
+    ("Romance", ["Antelmi", "Calambrone", "D_Odorico", "Roma", "Tonelli"], "Italian"),
 
-# Icelandic
-download_and_process_corpora("Scandinavian", ["Einarsdottir", "Kari"], "Icelandic")
+    # Japanese
+    ("Japanese", ["Hamasaki", "Ishii", "MiiPro", "Miyata", "NINJAL-Okubo", "Noji", "Ogawa", "Okayama", "Ota", "PaidoJapanese", "StanfordJapanese", "Yokoyama"], "Japanese"),
 
-# Indonesian
-download_and_process_corpora("EastAsian", ["Jakarta"], "Indonesian")
+    # Korean
+    ("EastAsian", ["Jiwon", "Ko", "Ryu"], "Korean"),
 
-# Irish
-download_and_process_corpora("Celtic", ["Gaeltacht", "Guilfoyle"], "Irish")
+    # Mandarin
+    ("Chinese", ["Chang1", "Chang2", "ChangPN", "ChangPlay", "Erbaugh", "LiReading", "LiZhou", "TCCM-reading", "TCCM", "Tong", "Xinjiang", "Zhou1", "Zhou2", "Zhou3", "ZhouAssessment", "ZhouDinner"], "Mandarin"),
 
-# Italian
-download_and_process_corpora("Romance", ["Antelmi", "Calambrone", "D_Odorico", "Roma", "Tonelli"], "Italian")
+    # Norwegian
+    ("Scandinavian", ["Garmann", "Ringstad"], "Norwegian"),
 
-# Japanese
-download_and_process_corpora("Japanese", ["Hamasaki", "Ishii", "MiiPro", "Miyata", "NINJAL-Okubo", "Noji", "Ogawa", "Okayama", "Ota", "PaidoJapanese", "StanfordJapanese", "Yokoyama"], "Japanese")
+    # Polish
+    ("Slavic", ["Szuman", "WeistJarosz"], "Polish"),
 
-# Korean
-download_and_process_corpora("EastAsian", ["Jiwon", "Ko", "Ryu"], "Korean")
+    # Portuguese (Brazil)
+    ("Romance", ["AlegreLong", "AlegreX"], "PortugueseBr"),
 
-# Mandarin
-download_and_process_corpora("Chinese", ["Chang1", "Chang2", "ChangPN", "ChangPlay", "Erbaugh", "LiReading", "LiZhou", "TCCM-reading", "TCCM", "Tong", "Xinjiang", "Zhou1", "Zhou2", "Zhou3", "ZhouAssessment", "ZhouDinner"], "Mandarin")
+    # Portuguese (Portugal)
+    ("Romance", ["Batoreo", "CCF", "Florianopolis", "Santos"], "PortuguesePt"),
 
-# Norwegian
-download_and_process_corpora("Scandinavian", ["Garmann", "Ringstad"], "Norwegian")
+    # Quechua
+    ("Other", ["Gelman", "Gildersleeve"], "Quechua"),
 
-# Polish
-download_and_process_corpora("Slavic", ["Szuman", "WeistJarosz"], "Polish")
+    # Romanian
+    ("Romance", ["Avram", "Goga", "KernRomanian"], "Romanian"),
 
-# Portuguese (Brazil)
-download_and_process_corpora("Romance", ["AlegreLong", "AlegreX"], "PortugueseBr")
+    # Spanish
+    ("Spanish", ["Aguirre", "BeCaCeSno", "ColMex", "DiezItza", "FernAguado", "Koine", "Linaza", "LlinasOjea", "Marrero", "Montes", "Nieva", "OreaPine", "Ornat", "Remedi", "Romero", "SerraSole", "Shiro", "Vila"], "Spanish"),
 
-# Portuguese (Portugal)
-download_and_process_corpora("Romance", ["Batoreo", "CCF", "Florianopolis", "Santos"], "PortuguesePt")
+    # Serbian
+    ("Slavic", ["SCECL"], "Serbian"),
 
-# Quechua
-download_and_process_corpora("Other", ["Gelman", "Gildersleeve"], "Quechua")
+    # Swedish
+    ("Scandinavian", ["Andren", "Lacerda", "Lund", "StanfordSwedish"], "Swedish"),
 
-# Romanian
-download_and_process_corpora("Romance", ["Avram", "Goga", "KernRomanian"], "Romanian")
+    # Thai
+    # ("EastAsian", ["CRSLP"], "Thai"),
+    # print("WARNING: Thai phonemization is not supported. Skipping phonemization for Thai.")
 
-# Spanish
-download_and_process_corpora("Spanish", ["Aguirre", "BeCaCeSno", "ColMex", "DiezItza", "FernAguado", "Koine", "Linaza", "LlinasOjea", "Marrero", "Montes", "Nieva", "OreaPine", "Ornat", "Remedi", "Romero", "SerraSole", "Shiro", "Vila"], "Spanish")
+    # Tamil
+    # ("Other", ["Narasimhan"], "Tamil"),
+    # print("WARNING: Too few utterances for Tamil. Skipping phonemization for Tamil.")
 
-# Serbian
-download_and_process_corpora("Slavic", ["SCECL"], "Serbian")
+    # Turkish
+    ("Other", ["Aksu", "Altinkamis"], "Turkish"),
 
-# Swedish
-download_and_process_corpora("Scandinavian", ["Andren", "Lacerda", "Lund", "StanfordSwedish"], "Swedish")
+    # Welsh
+    ("Celtic", ["CIG1", "CIG2"], "Welsh"),
+]
 
-# Thai
-# download_and_process_corpora("EastAsian", ["CRSLP"], "Thai")
-# print("WARNING: Thai phonemization is not supported. Skipping phonemization for Thai.")
+def phonemize_language_name(language):
+    """ Returns the name of a language in the phonemizer config. """
 
-# Tamil
-# download_and_process_corpora("Other", ["Narasimhan"], "Tamil")
-# print("WARNING: Too few utterances for Tamil. Skipping phonemization for Tamil.")
+    if language == "Eng-NA":
+        return "EnglishNA"
+    elif language == "Eng-UK":
+        return "EnglishUK"
+    return language
 
-# Turkish
-download_and_process_corpora("Other", ["Aksu", "Altinkamis"], "Turkish")
+def download_and_process_corpora(collection, corpora, language):
+    if not SKIP_DOWNLOAD:
+        downloader = ChildesDownloader()
+        for corpus in corpora:
+            print(f"\n----------\nDOWNLOADING: Corpus: {corpus} in Collection: {collection} for Language: {language}\n----------\n")
+            downloader.download(collection, corpus,
+                                DOWNLOAD_OUT_PATH,
+                                separate_by_child=False)
 
-# Welsh
-download_and_process_corpora("Celtic", ["CIG1", "CIG2"], "Welsh")
+        if language != collection:
+            if (DOWNLOAD_OUT_PATH / language).exists():
+                shutil.rmtree(DOWNLOAD_OUT_PATH / language)
+            os.rename(DOWNLOAD_OUT_PATH / collection, DOWNLOAD_OUT_PATH / language)
+
+    processor = ChunkedChildesProcessor(DOWNLOAD_OUT_PATH / language,
+                                        keep_child_utterances=KEEP_CHILD_UTTERANCES,
+                                        max_age = MAX_AGE,
+                                        cache_dir=CACHE_PATH / language)
+
+    statistics = processor.process(phonemize_language_name(language), PROCESS_OUT_PATH / language)
+    return {key: value for key, value in statistics.items() if not isinstance(value, set)}
+
+def job_size(corpora, language):
+    """ Estimates how long processing a language takes from the size of its downloaded CSVs, or from its number of
+    corpora if they have not been downloaded yet. """
+
+    csv_paths = list((DOWNLOAD_OUT_PATH / language).glob('*.csv'))
+    if SKIP_DOWNLOAD and len(csv_paths) > 0:
+        return sum(csv_path.stat().st_size for csv_path in csv_paths)
+    return len(corpora)
+
+def summarize(language, result):
+    """ Returns the line of the run summary for a language. """
+
+    summary = {'language': language, 'status': result['status'], 'seconds': round(result['seconds'], 1)}
+    if result['status'] == 'done':
+        statistics = result['result']
+        summary.update({
+            'input_lines': statistics['input_lines'],
+            'lines': statistics['lines'],
+            'dropped_lines': statistics['input_lines'] - statistics['lines'],
+            'unphonemized_lines': statistics['unphonemized_lines'],
+            'lines_per_second': round(statistics['input_lines'] / result['seconds']),
+        })
+    else:
+        summary['error'] = result['error']
+    return summary
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    # Downloads share the collection folders, so they cannot run at the same time
+    jobs = [{
+        'name': language,
+        'function': download_and_process_corpora,
+        'args': (collection, corpora, language),
+        'cores': backend_cores(phonemize_language_name(language)) if SKIP_DOWNLOAD else 1,
+        'size': job_size(corpora, language),
+    } for collection, corpora, language in LANGUAGES]
+    results = run_jobs(jobs, MAX_CORES if SKIP_DOWNLOAD else 1)
+
+    summary = [summarize(language, result) for (_, _, language), result in zip(LANGUAGES, results)]
+    PROCESS_OUT_PATH.mkdir(exist_ok=True, parents=True)
+    with open(SUMMARY_PATH, 'w') as f:
+        json.dump(summary, f, indent=1)
+
+    print(f"\n{'language':<14} {'status':<7} {'seconds':>8} {'lines':>9} {'dropped':>9} {'lines/s':>9}")
+    for line in summary:
+        print(f"{line['language']:<14} {line['status']:<7} {line['seconds']:>8} {line.get('lines', ''):>9} {line.get('dropped_lines', ''):>9} {line.get('lines_per_second', ''):>9}")
+    print(f"\nSaved run summary to {SUMMARY_PATH}")
+
+if __name__ == '__main__':
+    main()
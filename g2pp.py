@@ -1,18 +1,134 @@
 """ Convert orthographic text to a stream of IPA phonemes. """
 
-from src.wrappers.epitran_wrapper import EpitranWrapper
-from src.wrappers.phonemizer_wrapper import PhonemizerWrapper
-from src.wrappers.pingyam_wrapper import PingyamWrapper
-from src.wrappers.pinyin_to_ipa_wrapper import PinyinToIpaWrapper
+import importlib
+import logging
+import os
+import threading
+from functools import lru_cache
+from itertools import islice
 
+from src.cache import PronunciationCache
+from src.wrappers.help import BACKEND_HELP
+
+# Import paths of the wrapper for each backend. Backend libraries are slow to import, so a wrapper's module is
+# only imported when its backend is used (see `get_wrapper_class`).
 WRAPPER_BACKENDS = {
-    'epitran': EpitranWrapper,
-    'phonemizer': PhonemizerWrapper,
-    'pingyam': PingyamWrapper,
-    'pinyin_to_ipa': PinyinToIpaWrapper,
+    'epitran': 'src.wrappers.epitran_wrapper.EpitranWrapper',
+    'phonemizer': 'src.wrappers.phonemizer_wrapper.PhonemizerWrapper',
+    'pingyam': 'src.wrappers.pingyam_wrapper.PingyamWrapper',
+    'pinyin_to_ipa': 'src.wrappers.pinyin_to_ipa_wrapper.PinyinToIpaWrapper',
 }
 
-def phonemize_utterances(lines, backend, language, keep_word_boundaries, verbose=False, use_folding=True, **wrapper_kwargs):
+DEFAULT_CHUNK_SIZE = 10_000
+
+@lru_cache(maxsize=None)
+def get_wrapper_class(backend):
+    """ Imports and returns the wrapper class for a backend.
+
+    Raises:
+        ValueError: If the backend is not supported.
+    """
+
+    if backend not in WRAPPER_BACKENDS:
+        raise ValueError(f'Backend "{backend}" not supported. Supported backends: {list(WRAPPER_BACKENDS.keys())}')
+    module_name, class_name = WRAPPER_BACKENDS[backend].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+def list_languages(backend):
+    """ Returns the languages supported by a backend, without building a wrapper.
+
+    Raises:
+        ValueError: If the backend is not supported.
+    """
+    return get_wrapper_class(backend).list_languages()
+
+class G2PSession:
+    """ A long-lived phonemizer for a single backend, language and set of options.
+
+    The wrapper (and any backend state it holds, such as espeak voices or epitran dictionaries) is built once
+    when the session is created and reused for every call to `phonemize`. Use `get_session` to share sessions
+    across a process rather than constructing them directly.
+    """
+
+    def __init__(self, backend, language, keep_word_boundaries, verbose=False, use_folding=True, cache_dir=None, **wrapper_kwargs):
+        """ Builds the wrapper for the session.
+
+        Args:
+            backend (str): The backend to use for phonemization.
+            language (str): The language to phonemize.
+            keep_word_boundaries (bool): Whether to keep word boundaries.
+            verbose (bool): Whether to print debug information.
+            use_folding (bool): Whether to use folding dictionaries to correct the wrapper's output.
+            cache_dir (str or Path): Directory of a persistent pronunciation cache to use. If None, uses the
+                G2PP_CACHE_DIR environment variable if it is set, otherwise no cache is used.
+            **wrapper_kwargs: Additional keyword arguments.
+
+        Raises:
+            ValueError: If the backend is not supported, or the wrapper rejects the language or arguments.
+        """
+
+        wrapper_class = get_wrapper_class(backend)
+        self.backend = backend
+        self.language = language
+        self.wrapper = wrapper_class(language=language, keep_word_boundaries=keep_word_boundaries, verbose=verbose, use_folding=use_folding, **wrapper_kwargs)
+
+        cache_dir = cache_dir if cache_dir is not None else os.getenv('G2PP_CACHE_DIR')
+        if cache_dir:
+            self.wrapper.cache = PronunciationCache(cache_dir, self.wrapper.cache_namespace())
+
+    def set_verbose(self, verbose):
+        """ Changes the logging level of the session's wrapper. """
+        self.wrapper.verbose = verbose
+        self.wrapper.logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+    def phonemize(self, lines):
+        """ Phonemizes lines with the session's wrapper. See `phonemize_utterances` for the output format. """
+        return self.wrapper.phonemize(lines)
+
+    def refold(self, lines):
+        """ Applies the folding dictionaries to raw output saved from a run with use_folding=False, without running the backend. """
+        return self.wrapper.fold(lines)
+
+    def close(self):
+        """ Releases resources held by the session's wrapper (such as worker processes) and its cache. """
+
+        self.wrapper.close()
+        if self.wrapper.cache is not None:
+            self.wrapper.cache.close()
+
+    def cache_stats(self):
+        """ Returns hit/miss statistics of the session's pronunciation cache, or None if no cache is used. """
+        return self.wrapper.cache.stats() if self.wrapper.cache is not None else None
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+def get_session(backend, language, keep_word_boundaries, verbose=False, use_folding=True, cache_dir=None, **wrapper_kwargs):
+    """ Returns the process-wide `G2PSession` for a configuration, creating it on first use.
+
+    Sessions are keyed by backend, language, keep_word_boundaries, use_folding, cache_dir and wrapper_kwargs, so the
+    setup cost of a backend is only paid once per process for each configuration. `verbose` is not part of
+    the key; it updates the logging level of the returned session instead.
+    """
+
+    key = (backend, language, keep_word_boundaries, use_folding, cache_dir, tuple(sorted(wrapper_kwargs.items())))
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = G2PSession(backend, language, keep_word_boundaries, verbose, use_folding, cache_dir, **wrapper_kwargs)
+            _SESSIONS[key] = session
+        else:
+            session.set_verbose(verbose)
+    return session
+
+def clear_sessions():
+    """ Closes and drops all cached sessions, so that the next call to `get_session` rebuilds its wrapper. """
+    with _SESSIONS_LOCK:
+        for session in _SESSIONS.values():
+            session.close()
+        _SESSIONS.clear()
+
+def phonemize_utterances(lines, backend, language, keep_word_boundaries, verbose=False, use_folding=True, cache_dir=None, as_corpus=False, **wrapper_kwargs):
     """ Phonemizes lines using a specified wrapper and language.
 
     Args:
@@ -22,10 +138,12 @@ def phonemize_utterances(lines, backend, language, keep_word_boundaries, verbose
         keep_word_boundaries (bool): Whether to keep word boundaries.
         verbose (bool): Whether to print debug information.
         use_folding (bool): Whether to use folding dictionaries to correct the wrapper's output.
+        cache_dir (str or Path): Directory of a persistent pronunciation cache (defaults to the G2PP_CACHE_DIR environment variable).
+        as_corpus (bool): Whether to return a `PhonemizedCorpus` (see `src/corpus.py`) instead of a list of strings.
         **wrapper_kwargs: Additional keyword arguments.
     
     Returns:
-        list of str: The phonemized lines.
+        list of str: The phonemized lines, or a `PhonemizedCorpus` of them if as_corpus=True.
 
     Raises:
         ValueError: If the backend is not supported.
@@ -33,6 +151,8 @@ def phonemize_utterances(lines, backend, language, keep_word_boundaries, verbose
         ValueError: If an argument is not supported by the wrapper.
         ValueError: If an argument is not the correct type.
 
+    The wrapper for each configuration is built once per process (see `get_session`) and reused by later calls.
+
     The returned list will be the same length as `lines`. Each line will be a string of space-separated IPA phonemes,
     with 'WORD_BOUNDARY' separating words if keep_word_boundaries=True. Lines that could not be phonemized are returned as empty strings.
 
@@ -41,10 +161,72 @@ def phonemize_utterances(lines, backend, language, keep_word_boundaries, verbose
     Output: ['h ə l oʊ WORD_BOUNDARY ð ɛ ɹ WORD_BOUNDARY', 'ð ɪ s WORD_BOUNDARY ɪ z WORD_BOUNDARY ə WORD_BOUNDARY t ɛ s t WORD_BOUNDARY']
     """
 
-    if backend not in WRAPPER_BACKENDS:
-        raise ValueError(f'Backend "{backend}" not supported. Supported backends: {list(WRAPPER_BACKENDS.keys())}')
-    wrapper = WRAPPER_BACKENDS[backend](language=language, keep_word_boundaries=keep_word_boundaries, verbose=verbose, use_folding=use_folding, **wrapper_kwargs)
-    return wrapper.phonemize(lines)
+    session = get_session(backend, language, keep_word_boundaries, verbose, use_folding, cache_dir, **wrapper_kwargs)
+    phonemized = session.phonemize(lines)
+    if as_corpus:
+        from src.corpus import PhonemizedCorpus
+        return PhonemizedCorpus.from_lines(phonemized, keep_word_boundaries)
+    return phonemized
+
+def phonemize_stream(lines, backend, language, keep_word_boundaries, verbose=False, use_folding=True, chunk_size=DEFAULT_CHUNK_SIZE, cache_dir=None, **wrapper_kwargs):
+    """ Phonemizes an iterable of lines lazily, a chunk at a time.
+
+    Args:
+        lines (iterable of str): The lines to phonemize. Can be a file object or any other iterable; trailing newlines are stripped.
+        backend (str): The backend to use for phonemization.
+        language (str): The language to phonemize.
+        keep_word_boundaries (bool): Whether to keep word boundaries.
+        verbose (bool): Whether to print debug information.
+        use_folding (bool): Whether to use folding dictionaries to correct the wrapper's output.
+        chunk_size (int): The number of lines read and phonemized at a time.
+        cache_dir (str or Path): Directory of a persistent pronunciation cache (defaults to the G2PP_CACHE_DIR environment variable).
+        **wrapper_kwargs: Additional keyword arguments.
+
+    Yields:
+        str: The phonemized lines, in the same order as the input.
+
+    Only `chunk_size` lines are held in memory at once, so this can be used on corpora that do not fit in memory.
+    See `phonemize_utterances` for the output format and the errors raised.
+    """
+
+    if chunk_size < 1:
+        raise ValueError(f'chunk_size must be a positive integer. Got {chunk_size} instead.')
+    session = get_session(backend, language, keep_word_boundaries, verbose, use_folding, cache_dir, **wrapper_kwargs)
+    lines = iter(lines)
+    while True:
+        chunk = [line.strip() for line in islice(lines, chunk_size)]
+        if len(chunk) == 0:
+            return
+        yield from session.phonemize(chunk)
+
+def refold_stream(lines, backend, language, keep_word_boundaries, verbose=False, chunk_size=DEFAULT_CHUNK_SIZE, **wrapper_kwargs):
+    """ Applies the current folding dictionaries to raw output of a backend, a chunk at a time.
+
+    Args:
+        lines (iterable of str): Lines of raw output, as produced with use_folding=False (`-u` on the command line).
+            Trailing newlines are removed, but other whitespace is kept as it can be matched by the folding dictionaries.
+        backend (str): The backend that produced the output.
+        language (str): The language of the output.
+        keep_word_boundaries (bool): Whether the output was produced with word boundaries.
+        verbose (bool): Whether to print debug information.
+        chunk_size (int): The number of lines read and refolded at a time.
+        **wrapper_kwargs: Additional keyword arguments used to produce the output.
+
+    Yields:
+        str: The corrected lines, identical to what the backend would have produced with use_folding=True.
+
+    This makes it possible to iterate on the folding dictionaries in `src/dicts.py` without re-running the backend.
+    """
+
+    if chunk_size < 1:
+        raise ValueError(f'chunk_size must be a positive integer. Got {chunk_size} instead.')
+    session = get_session(backend, language, keep_word_boundaries, verbose, True, **wrapper_kwargs)
+    lines = iter(lines)
+    while True:
+        chunk = [line.rstrip('\n') for line in islice(lines, chunk_size)]
+        if len(chunk) == 0:
+            return
+        yield from session.refold(chunk)
 
 def character_split_utterances(lines):
     """ Used to split a line of orthographic text into characters separated by spaces.
@@ -57,6 +239,17 @@ def character_split_utterances(lines):
     """
     return [' '.join(['WORD_BOUNDARY' if c == ' ' else c for c in list(line.strip())]) + ' WORD_BOUNDARY' for line in lines]
 
+def parse_wrapper_kwarg(kwarg_type, value):
+    """ Converts a wrapper argument given on the command line to its type. Booleans accept true/false, yes/no and 1/0. """
+
+    if kwarg_type is bool:
+        if value.lower() in ('true', 'yes', '1'):
+            return True
+        if value.lower() in ('false', 'no', '0'):
+            return False
+        raise ValueError(f'Cannot interpret "{value}" as a bool.')
+    return kwarg_type(value)
+
 def main():
     import argparse
     import sys
@@ -69,13 +262,14 @@ def main():
         def format_help(self):
             help_text = super().format_help()
             help_text += "\nBackends:\n"
+            # The help text is kept apart from the wrappers, so that printing it does not import any backend
             for backend in WRAPPER_BACKENDS.keys():
+                languages_message, kwargs_help = BACKEND_HELP[backend]
                 help_text += f"\n{backend}:\n"
-                wrapper_class = WRAPPER_BACKENDS[backend]
-                help_text += "  " + wrapper_class.supported_languages_message().replace('\n', '\n' + ' ' * 2)
-                if len(wrapper_class.KWARGS_HELP) > 0:
+                help_text += "  " + languages_message.replace('\n', '\n' + ' ' * 2)
+                if len(kwargs_help) > 0:
                     help_text += "Additional arguments:\n"
-                    for key, value in wrapper_class.KWARGS_HELP.items():
+                    for key, value in kwargs_help.items():
                         help_text += f"    {key}: {value}\n"
             help_text += "\n\nExample usage:\n"
             help_text += "  python phonemize.py epitran --language eng-Latn --keep-word-boundaries --verbose < input.txt > output.txt\n"
@@ -87,10 +281,16 @@ def main():
     parser.add_argument("-k", "--keep-word-boundaries", action="store_true", help="Keep word boundaries in the output.")
     parser.add_argument("-v", "--verbose", action="store_true", help="Print debug information.")
     parser.add_argument("-u", "--uncorrected", action="store_false", help="Use the wrapper's output without applying a folding dictionary to correct the phoneme sets.")
+    parser.add_argument("-r", "--refold", action="store_true", help="Treat the input as uncorrected output saved with -u and only apply the folding dictionaries, without running the backend.")
     parser.add_argument("-i", "--input-file", type=argparse.FileType('r'), default=sys.stdin, help="Input file containing utterances (one per line). If not specified, reads from stdin.")
     parser.add_argument("-o", "--output-file", type=argparse.FileType('w'), default=sys.stdout, help="Output file for phonemized utterances. If not specified, writes to stdout.")
+    parser.add_argument("--cache-dir", default=None, help="Directory of a persistent pronunciation cache, reused across runs. Defaults to the G2PP_CACHE_DIR environment variable, if set.")
+    parser.add_argument("-j", "--jobs", default=None, help="Number of parallel jobs for backends that support it, or 'auto' for one per CPU.")
+    parser.add_argument("-e", "--encoded-output", default=None, help="Write the output to this directory as an integer-encoded corpus (phoneme IDs, utterance offsets and a JSON vocabulary) instead of text.")
+    parser.add_argument("-c", "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help=f"Number of lines to read and phonemize at a time (default: {DEFAULT_CHUNK_SIZE}).")
     
     args, unknown = parser.parse_known_args()
+    wrapper_class = get_wrapper_class(args.backend)
 
     # Convert remaining unknown args to wrapper_kwargs
     wrapper_kwargs = {}
@@ -101,30 +301,67 @@ def main():
             except ValueError:
                 print(f"Error: Argument '{arg}' must be in the form '--key=value'.", file=sys.stderr)
                 sys.exit(1)
-            if key in WRAPPER_BACKENDS[args.backend].WRAPPER_KWARGS_TYPES:
+            if key in wrapper_class.WRAPPER_KWARGS_TYPES:
                 try:
-                    wrapper_kwargs[key] = WRAPPER_BACKENDS[args.backend].WRAPPER_KWARGS_TYPES[key](value)
+                    wrapper_kwargs[key] = parse_wrapper_kwarg(wrapper_class.WRAPPER_KWARGS_TYPES[key], value)
                 except ValueError:
-                    print(f"Error: Argument '{key}' must be of type {WRAPPER_BACKENDS[args.backend].WRAPPER_KWARGS_TYPES[key].__name__}. Got '{value}' instead.", file=sys.stderr)
+                    print(f"Error: Argument '{key}' must be of type {wrapper_class.WRAPPER_KWARGS_TYPES[key].__name__}. Got '{value}' instead.", file=sys.stderr)
                     sys.exit(1)
 
-    lines = args.input_file.readlines()
-    lines = [line.strip() for line in lines]
+    if args.jobs is not None:
+        if 'njobs' not in wrapper_class.WRAPPER_KWARGS_TYPES:
+            print(f"Error: The {args.backend} backend does not support parallel jobs.", file=sys.stderr)
+            sys.exit(1)
+        try:
+            wrapper_kwargs['njobs'] = 0 if args.jobs == 'auto' else int(args.jobs)
+        except ValueError:
+            print(f"Error: --jobs must be an integer or 'auto'. Got '{args.jobs}' instead.", file=sys.stderr)
+            sys.exit(1)
+
+    if args.refold and not args.uncorrected:
+        print("Error: --refold applies the folding dictionaries, so it cannot be combined with -u.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.encoded_output is not None and args.output_file is not sys.stdout:
+        print("Error: --encoded-output replaces the text output, so it cannot be combined with -o.", file=sys.stderr)
+        sys.exit(1)
 
     try:
-        phonemized_lines = phonemize_utterances(
-            lines,
-            args.backend,
-            args.language,
-            args.keep_word_boundaries,
-            args.verbose,
-            args.uncorrected,
-            **wrapper_kwargs
-        )
-        
-        for line in phonemized_lines:
+        if args.refold:
+            phonemized_lines = refold_stream(
+                args.input_file,
+                args.backend,
+                args.language,
+                args.keep_word_boundaries,
+                args.verbose,
+                args.chunk_size,
+                **wrapper_kwargs
+            )
+        else:
+            phonemized_lines = phonemize_stream(
+                args.input_file,
+                args.backend,
+                args.language,
+                args.keep_word_boundaries,
+                args.verbose,
+                args.uncorrected,
+                args.chunk_size,
+                args.cache_dir,
+                **wrapper_kwargs
+            )
+
+        if args.encoded_output is not None:
+            from src.corpus import save_encoded_corpus
+            save_encoded_corpus(phonemized_lines, args.encoded_output, args.chunk_size)
+            return
+
+        # Write each chunk as soon as it is phonemized, so an interrupted run keeps everything already done
+        for i, line in enumerate(phonemized_lines, start=1):
             args.output_file.write(line + '\n')
-    
+            if i % args.chunk_size == 0:
+                args.output_file.flush()
+        args.output_file.flush()
+
     except ValueError as e:
         print(f"Error: {str(e)}", file=sys.stderr)
         sys.exit(1)
@@ -0,0 +1,49 @@
+""" Measures the startup time of g2pp: the time to `import g2pp`, to print the help of the command-line interface and
+to phonemize a single line with it. Run from the root of the repository, e.g.
+
+    python scripts/benchmark_startup.py --backend phonemizer --language en-us --repeats 10
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+def time_command(command, stdin, repeats):
+    """ Runs a command `repeats` times and returns the wall time of each run, in seconds. """
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(command, input=stdin, cwd=ROOT, check=True, stdout=subprocess.DEVNULL, text=True)
+        times.append(time.perf_counter() - start)
+    return times
+
+def report(name, times):
+    print(f'{name:<40} min {min(times):.3f}s  median {statistics.median(times):.3f}s  max {max(times):.3f}s')
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of g2pp.")
+    parser.add_argument("--backend", default="phonemizer", help="The backend to phonemize the line with.")
+    parser.add_argument("--language", default="en-us", help="The language to phonemize the line with.")
+    parser.add_argument("--line", default="hello there", help="The line to phonemize.")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of times to run each measurement.")
+    args = parser.parse_args()
+
+    # Check that importing g2pp does not import any backend (only the help text of the wrappers)
+    check = 'import sys, g2pp; print(",".join(sorted(m for m in sys.modules if m.startswith("src.wrappers.") and m != "src.wrappers.help")))'
+    imported = subprocess.run([sys.executable, '-c', check], cwd=ROOT, check=True, capture_output=True, text=True).stdout.strip()
+    if imported:
+        print(f'Warning: importing g2pp also imports {imported}')
+
+    report('python', time_command([sys.executable, '-c', 'pass'], None, args.repeats))
+    report('import g2pp', time_command([sys.executable, '-c', 'import g2pp'], None, args.repeats))
+    report('g2pp.py --help', time_command([sys.executable, 'g2pp.py', '--help'], None, args.repeats))
+    report(f'g2pp.py {args.backend} {args.language} (1 line)', time_command([sys.executable, 'g2pp.py', args.backend, args.language], args.line + '\n', args.repeats))
+
+if __name__ == "__main__":
+    main()
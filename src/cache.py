@@ -0,0 +1,130 @@
+""" Persistent on-disk cache of phonemized text. """
+
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+
+class PronunciationCache:
+    """ Stores the output of a wrapper for each line (or word, in lexicon mode) in an SQLite database.
+
+    Entries are grouped by a namespace that identifies everything the output depends on (see
+    `Wrapper.cache_namespace`), so one database can be shared by all backends and languages. The database uses
+    write-ahead logging, so several processes can read and write it at the same time. When the entries grow
+    beyond `max_size` bytes, the least recently used entries are evicted.
+
+    The total size is only summed over the whole table when a running estimate (the size when first written to, plus
+    everything written since by this process) goes over `max_size`, so writes do not scan the table. Writes made by
+    other processes are only counted at that point.
+    """
+
+    DEFAULT_MAX_SIZE = 2 ** 30
+    FILENAME = 'pronunciations.sqlite'
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self, cache_dir, namespace, max_size=DEFAULT_MAX_SIZE):
+        """
+        Args:
+            cache_dir (str or Path): Directory in which the database is stored. Created if it does not exist.
+            namespace (str): Identifies the configuration that the cached outputs belong to.
+            max_size (int): Maximum total size of the cached text, in bytes, before old entries are evicted.
+        """
+
+        self.path = Path(cache_dir) / self.FILENAME
+        self.namespace = namespace
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger(f"{__name__}.{self.__class__.__name__}")
+        self._connection = None
+        self._pid = None
+        self._size_estimate = None
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS entries (namespace TEXT, text TEXT, value TEXT, size INTEGER, accessed REAL, PRIMARY KEY (namespace, text))')
+            connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)')
+
+    def _connect(self):
+        """ Returns a connection to the database, opening a new one in each process (connections cannot be shared across a fork). """
+
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=60)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._pid = os.getpid()
+        return self._connection
+
+    def get_many(self, texts):
+        """ Returns a dictionary mapping each text found in the cache to its cached output. """
+
+        texts = list(texts)
+        found = {}
+        connection = self._connect()
+        for start in range(0, len(texts), self.QUERY_BATCH_SIZE):
+            batch = texts[start:start + self.QUERY_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            rows = connection.execute(f'SELECT text, value FROM entries WHERE namespace = ? AND text IN ({placeholders})', [self.namespace, *batch])
+            found.update(rows)
+        if len(found) > 0:
+            with connection:
+                connection.executemany('UPDATE entries SET accessed = ? WHERE namespace = ? AND text = ?', [(time.time(), self.namespace, text) for text in found])
+        self.hits += len(found)
+        self.misses += len(texts) - len(found)
+        return found
+
+    def put_many(self, items):
+        """ Stores (text, output) pairs in the cache, evicting old entries if the cache is over its maximum size. """
+
+        now = time.time()
+        rows = [(self.namespace, text, value, len(text.encode('utf-8')) + len(value.encode('utf-8')), now) for text, value in items]
+        if len(rows) == 0:
+            return
+        connection = self._connect()
+        with connection:
+            connection.executemany('INSERT OR REPLACE INTO entries (namespace, text, value, size, accessed) VALUES (?, ?, ?, ?, ?)', rows)
+        if self._size_estimate is None:
+            self._size_estimate = self._total_size()
+        else:
+            # Replaced entries are counted twice, which only makes the exact check below happen sooner
+            self._size_estimate += sum(row[3] for row in rows)
+        if self._size_estimate > self.max_size:
+            self._evict()
+
+    def _total_size(self):
+        return self._connect().execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _evict(self):
+        """ Removes the least recently used entries until the cache is below 90% of its maximum size. """
+
+        connection = self._connect()
+        total_size = self._total_size()
+        self._size_estimate = total_size
+        if total_size <= self.max_size:
+            return
+        to_free = total_size - int(self.max_size * 0.9)
+        freed = 0
+        rowids = []
+        for rowid, size in connection.execute('SELECT rowid, size FROM entries ORDER BY accessed'):
+            rowids.append((rowid,))
+            freed += size
+            if freed >= to_free:
+                break
+        with connection:
+            connection.executemany('DELETE FROM entries WHERE rowid = ?', rowids)
+        self._size_estimate = total_size - freed
+        self.logger.debug(f'Evicted {len(rowids)} entries ({freed} bytes) from the pronunciation cache.')
+
+    def stats(self):
+        """ Returns the number of hits and misses in this process, and the number of entries and bytes stored in this namespace. """
+
+        entries, size = self._connect().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE namespace = ?', (self.namespace,)).fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'size': size}
+
+    def close(self):
+        """ Closes the connection to the database. """
+
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
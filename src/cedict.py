@@ -0,0 +1,102 @@
+""" Memory-mapped index of the CC-CEDICT dictionary used by epitran for Mandarin.
+
+Epitran parses the CEDICT text file (about 120k entries) every time an Epitran instance is built for `cmn-Hans` or
+`cmn-Hant`. Here, the parsed dictionary is saved next to the source file as a marisa trie, keyed by a hash of the
+source, so that later processes can map it into memory instead of parsing the file again. Since the trie is
+memory-mapped, processes forked from the same parent also share its pages.
+"""
+
+from functools import lru_cache
+import glob
+import logging
+import os
+import tempfile
+
+import marisa_trie
+from epitran.cedict import CEDictTrie
+
+from .utils import file_hash
+
+logger = logging.getLogger(__name__)
+
+class _TrieHanzi:
+    """ Read-only view of a trie that mimics the `hanzi` dictionary of `CEDictTrie`, mapping each headword to its
+    pinyin (as a single-item list) and English definitions (not stored). """
+
+    def __init__(self, trie):
+        self.trie = trie
+
+    def __contains__(self, key):
+        return key in self.trie
+
+    def __getitem__(self, key):
+        return [self.trie[key][0].decode('utf-8')], None
+
+    def __len__(self):
+        return len(self.trie)
+
+class MappedCEDictTrie(CEDictTrie):
+    """ Drop-in replacement for epitran's `CEDictTrie`, backed by a memory-mapped trie of headwords and pinyin. """
+
+    def __init__(self, trie):
+        self.trie = trie
+        self.hanzi = _TrieHanzi(trie)
+
+def _build_trie(cedict_file, traditional):
+    """ Parses CEDICT with epitran's parser and returns a trie mapping headwords to their joined pinyin. """
+
+    parsed = CEDictTrie(cedict_file, traditional=traditional)
+    return marisa_trie.BytesTrie((hanzi, ''.join(pinyin).encode('utf-8')) for hanzi, (pinyin, _) in parsed.hanzi.items())
+
+def _umask():
+    """ Returns the umask of the process (which can only be read by setting it). """
+
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def _remove_stale_indexes(cedict_file, variant, index_path):
+    """ Removes the indexes of a CEDICT variant built from earlier versions of the file. """
+
+    for path in glob.glob(f'{glob.escape(cedict_file)}.{variant}.*.marisa'):
+        if path == index_path:
+            continue
+        try:
+            os.remove(path)
+            logger.debug(f'Removed stale CEDICT index {path}.')
+        except OSError as e:
+            logger.debug(f'Could not remove stale CEDICT index {path} ({e}).')
+
+@lru_cache(maxsize=None)
+def load_cedict_trie(cedict_file, traditional=False):
+    """ Returns a `MappedCEDictTrie` for a CEDICT file, loaded at most once per process.
+
+    The trie is memory-mapped from `<cedict_file>.<variant>.<hash>.marisa` if it exists. Otherwise CEDICT is parsed
+    and the trie is saved there for later processes, removing the indexes of earlier versions of the file. If it
+    cannot be saved, the trie is kept in memory.
+    """
+
+    variant = 'traditional' if traditional else 'simplified'
+    index_path = f'{cedict_file}.{variant}.{file_hash(cedict_file)[:16]}.marisa'
+    trie = marisa_trie.BytesTrie()
+    if os.path.exists(index_path):
+        logger.debug(f'Loading CEDICT index from {index_path}.')
+        trie.mmap(index_path)
+        return MappedCEDictTrie(trie)
+
+    logger.debug(f'Building CEDICT index for {cedict_file}...')
+    built = _build_trie(cedict_file, traditional)
+    try:
+        # Write to a temporary file first so that concurrent processes never map a partially written index
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(index_path), suffix='.tmp')
+        os.close(fd)
+        built.save(tmp_path)
+        # mkstemp creates the file readable only by its owner, but other users should be able to map the index too
+        os.chmod(tmp_path, 0o644 & ~_umask())
+        os.replace(tmp_path, index_path)
+    except OSError as e:
+        logger.debug(f'Could not save CEDICT index to {index_path} ({e}), keeping it in memory.')
+        return MappedCEDictTrie(built)
+    _remove_stale_indexes(cedict_file, variant, index_path)
+    trie.mmap(index_path)
+    return MappedCEDictTrie(trie)
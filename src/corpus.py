@@ -0,0 +1,306 @@
+""" Integer-encoded phoneme corpora.
+
+A phonemized corpus can be saved as a directory containing:
+
+- `tokens.bin`: the phoneme IDs of every utterance, one after another, each utterance followed by the utterance
+  boundary token, as a flat array of unsigned 16-bit integers.
+- `offsets.bin`: the position of the first token of each utterance in `tokens.bin`, followed by the total number of
+  tokens, as unsigned 64-bit integers.
+- `vocab.json`: the phoneme for each ID, and the number of utterances and tokens.
+
+The arrays are written incrementally, so a corpus can be encoded as it is phonemized, and they are memory-mapped by
+`load_encoded_corpus`, so any utterance can be read without loading the whole corpus.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+UTTERANCE_BOUNDARY = 'UTT_BOUNDARY'
+WORD_BOUNDARY = 'WORD_BOUNDARY'
+
+TOKENS_FILE = 'tokens.bin'
+OFFSETS_FILE = 'offsets.bin'
+VOCAB_FILE = 'vocab.json'
+
+TOKEN_DTYPE = np.uint16
+OFFSET_DTYPE = np.uint64
+
+class EncodedCorpusWriter:
+    """ Writes phonemized utterances to an integer-encoded corpus directory.
+
+    The vocabulary always starts with the utterance boundary (ID 0) and the word boundary (ID 1). Other phonemes
+    are given IDs in the order they first appear. Empty utterances (lines that could not be phonemized) are kept,
+    so that utterance indices match the input lines.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str or Path): Directory to write the corpus to. Created if it does not exist.
+        """
+
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.vocab = {UTTERANCE_BOUNDARY: 0, WORD_BOUNDARY: 1}
+        self.num_utterances = 0
+        self.num_tokens = 0
+        self._tokens_file = open(self.path / TOKENS_FILE, 'wb')
+        self._offsets_file = open(self.path / OFFSETS_FILE, 'wb')
+        np.zeros(1, dtype=OFFSET_DTYPE).tofile(self._offsets_file)
+
+    def encode(self, line):
+        """ Returns the phoneme IDs of a space-separated line, adding new phonemes to the vocabulary.
+
+        Raises:
+            ValueError: If the vocabulary grows beyond the range of the token type.
+        """
+
+        ids = []
+        for phoneme in line.split():
+            if phoneme not in self.vocab:
+                if len(self.vocab) > np.iinfo(TOKEN_DTYPE).max:
+                    raise ValueError(f'Too many distinct phonemes to encode with {np.dtype(TOKEN_DTYPE).name}.')
+                self.vocab[phoneme] = len(self.vocab)
+            ids.append(self.vocab[phoneme])
+        return ids
+
+    def write(self, lines):
+        """ Encodes and appends a batch of phonemized lines to the corpus. """
+
+        tokens = []
+        offsets = []
+        for line in lines:
+            tokens.extend(self.encode(line))
+            tokens.append(self.vocab[UTTERANCE_BOUNDARY])
+            offsets.append(self.num_tokens + len(tokens))
+        np.array(tokens, dtype=TOKEN_DTYPE).tofile(self._tokens_file)
+        np.array(offsets, dtype=OFFSET_DTYPE).tofile(self._offsets_file)
+        self.num_utterances += len(offsets)
+        self.num_tokens += len(tokens)
+
+    def close(self):
+        """ Flushes the arrays and writes the vocabulary. """
+
+        self._tokens_file.close()
+        self._offsets_file.close()
+        with open(self.path / VOCAB_FILE, 'w', encoding='utf-8') as f:
+            json.dump({
+                'tokens': list(self.vocab),
+                'utterance_boundary': UTTERANCE_BOUNDARY,
+                'word_boundary': WORD_BOUNDARY,
+                'num_utterances': self.num_utterances,
+                'num_tokens': self.num_tokens,
+            }, f, ensure_ascii=False, indent=1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def save_encoded_corpus(lines, path, chunk_size=10_000):
+    """ Writes phonemized lines (any iterable of strings) to an integer-encoded corpus directory. """
+
+    with EncodedCorpusWriter(path) as writer:
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) == chunk_size:
+                writer.write(batch)
+                batch = []
+        writer.write(batch)
+
+def _map_array(path, dtype):
+    # numpy cannot memory-map an empty file
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r')
+
+class EncodedCorpus:
+    """ A memory-mapped, integer-encoded corpus written by `EncodedCorpusWriter`.
+
+    Indexing returns the phoneme IDs of an utterance (without the utterance boundary) as a read-only view of the
+    mapped token array.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str or Path): Directory containing the corpus.
+        """
+
+        self.path = Path(path)
+        with open(self.path / VOCAB_FILE, encoding='utf-8') as f:
+            info = json.load(f)
+        self.vocab = info['tokens']
+        self.token_to_id = {token: i for i, token in enumerate(self.vocab)}
+        self.tokens = _map_array(self.path / TOKENS_FILE, TOKEN_DTYPE)
+        self.offsets = _map_array(self.path / OFFSETS_FILE, OFFSET_DTYPE)
+        if len(self.offsets) != info['num_utterances'] + 1 or len(self.tokens) != info['num_tokens']:
+            raise ValueError(f'Encoded corpus at {self.path} is incomplete or corrupted.')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f'Utterance index {index} out of range for corpus of {len(self)} utterances.')
+        return self.tokens[int(self.offsets[index]):int(self.offsets[index + 1]) - 1]
+
+    def decode(self, index):
+        """ Returns an utterance as a space-separated string of phonemes, as written by `g2pp.py`. """
+        return ' '.join(self.vocab[i] for i in self[index])
+
+def load_encoded_corpus(path):
+    """ Memory-maps an integer-encoded corpus directory. """
+    return EncodedCorpus(path)
+
+def _offset_dtype(max_value):
+    """ Returns the smallest unsigned integer type used for offsets that can hold `max_value`. """
+    return np.uint32 if max_value <= np.iinfo(np.uint32).max else np.uint64
+
+class PhonemizedCorpus:
+    """ Phonemized utterances stored as compressed sparse rows, rather than as a list of strings.
+
+    `tokens` holds the phoneme IDs of every word of every utterance, without boundaries. Word `j` is
+    `tokens[word_offsets[j]:word_offsets[j + 1]]`, and utterance `i` is made of words
+    `utterance_offsets[i]` to `utterance_offsets[i + 1]`. If the utterances have word boundaries, each word is ended
+    by a `WORD_BOUNDARY` (a final word without one is kept as a word). Otherwise, each non-empty utterance is a single
+    word. Utterances that could not be phonemized have no words.
+
+    Counts take constant time, contiguous slices are views of the same arrays, and utterances are only converted
+    back to strings when they are accessed. Only the phonemes and word boundaries are stored, so the strings are
+    normalised: phonemes are separated by single spaces, without leading or trailing whitespace, lines that held
+    only whitespace (such as `' '`) become `''`, and with word boundaries, a final word without one is given one.
+    """
+
+    def __init__(self, tokens, word_offsets, utterance_offsets, vocab, keep_word_boundaries):
+        """
+        Args:
+            tokens (np.ndarray): Phoneme IDs.
+            word_offsets (np.ndarray): Start of each word in `tokens`, followed by the end of the last word.
+            utterance_offsets (np.ndarray): Index of the first word of each utterance, followed by the end of the last utterance.
+            vocab (list of str): The phoneme for each ID.
+            keep_word_boundaries (bool): Whether the utterances have word boundaries.
+        """
+
+        self.tokens = tokens
+        self.word_offsets = word_offsets
+        self.utterance_offsets = utterance_offsets
+        self.vocab = vocab
+        self.keep_word_boundaries = keep_word_boundaries
+
+    @classmethod
+    def from_lines(cls, lines, keep_word_boundaries=True, vocab=None):
+        """ Encodes phonemized lines, as returned by `phonemize_utterances`.
+
+        Args:
+            lines (iterable of str): Space-separated phonemes, with `WORD_BOUNDARY` after each word if keep_word_boundaries is True.
+            keep_word_boundaries (bool): Whether the lines have word boundaries.
+            vocab (list of str): An existing vocabulary to extend, so that several corpora share phoneme IDs. New
+                phonemes are appended to it in place.
+
+        Raises:
+            ValueError: If the vocabulary grows beyond the range of the token type.
+        """
+
+        vocab = vocab if vocab is not None else []
+        token_to_id = {token: i for i, token in enumerate(vocab)}
+        max_id = np.iinfo(TOKEN_DTYPE).max
+        tokens = []
+        word_offsets = [0]
+        utterance_offsets = [0]
+        for line in lines:
+            phonemes = line.split()
+            word_start = len(tokens)
+            for phoneme in phonemes:
+                if keep_word_boundaries and phoneme == WORD_BOUNDARY:
+                    word_offsets.append(len(tokens))
+                    word_start = len(tokens)
+                    continue
+                token = token_to_id.get(phoneme)
+                if token is None:
+                    if len(vocab) > max_id:
+                        raise ValueError(f'Too many distinct phonemes to encode with {np.dtype(TOKEN_DTYPE).name}.')
+                    token = token_to_id[phoneme] = len(vocab)
+                    vocab.append(phoneme)
+                tokens.append(token)
+            if len(tokens) > word_start or (not keep_word_boundaries and len(phonemes) > 0):
+                word_offsets.append(len(tokens))
+            utterance_offsets.append(len(word_offsets) - 1)
+
+        return cls(
+            np.array(tokens, dtype=TOKEN_DTYPE),
+            np.array(word_offsets, dtype=_offset_dtype(len(tokens))),
+            np.array(utterance_offsets, dtype=_offset_dtype(len(word_offsets))),
+            vocab,
+            keep_word_boundaries,
+        )
+
+    def __len__(self):
+        return len(self.utterance_offsets) - 1
+
+    @property
+    def num_words(self):
+        """ The number of words in the corpus. """
+        return int(self.utterance_offsets[-1] - self.utterance_offsets[0])
+
+    @property
+    def num_phonemes(self):
+        """ The number of phonemes in the corpus, not counting word boundaries. """
+        return int(self.word_offsets[self.utterance_offsets[-1]] - self.word_offsets[self.utterance_offsets[0]])
+
+    def words_per_utterance(self):
+        """ Returns an array with the number of words in each utterance. """
+        return np.diff(self.utterance_offsets.astype(np.int64))
+
+    def phonemes_per_utterance(self):
+        """ Returns an array with the number of phonemes in each utterance. """
+        ends = self.word_offsets[self.utterance_offsets[1:]].astype(np.int64)
+        starts = self.word_offsets[self.utterance_offsets[:-1]].astype(np.int64)
+        return ends - starts
+
+    def utterance_words(self, index):
+        """ Returns the phoneme IDs of each word of an utterance, as a list of arrays. """
+
+        first, last = int(self.utterance_offsets[index]), int(self.utterance_offsets[index + 1])
+        return [self.tokens[self.word_offsets[j]:self.word_offsets[j + 1]] for j in range(first, last)]
+
+    def _to_string(self, index):
+        words = [' '.join(self.vocab[token] for token in word) for word in self.utterance_words(index)]
+        if not self.keep_word_boundaries:
+            return ' '.join(words)
+        return ' '.join(word + ' ' + WORD_BOUNDARY if word else WORD_BOUNDARY for word in words)
+
+    def __getitem__(self, index):
+        """ Returns utterance `index` as a string, or a contiguous slice of the corpus as a new corpus sharing the same arrays. """
+
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError('PhonemizedCorpus only supports contiguous slices.')
+            stop = max(start, stop)
+            return PhonemizedCorpus(self.tokens, self.word_offsets, self.utterance_offsets[start:stop + 1], self.vocab, self.keep_word_boundaries)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f'Utterance index {index} out of range for corpus of {len(self)} utterances.')
+        return self._to_string(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._to_string(index)
+
+    def to_strings(self):
+        """ Returns the utterances as a list of strings in the format returned by `phonemize_utterances`, with the
+        whitespace normalised (see `PhonemizedCorpus`). """
+        return list(self)
+
+    @property
+    def nbytes(self):
+        """ The memory used by the arrays, in bytes. """
+        return self.tokens.nbytes + self.word_offsets.nbytes + self.utterance_offsets.nbytes
@@ -726,6 +726,13 @@ FOLDING_PINGYAM = {
 
 }
 
+# The rules of FOLDING_PINGYAM that can match across the join between two syllables of a word, written as the folded
+# phonemes on either side of the join. Every other rule only matches within a syllable (syllables end with a tone
+# marker or a coda consonant).
+FOLDING_PINGYAM_JUNCTIONS = {
+	't s' : 'ts',
+}
+
 FOLDING_EPITRAN = {
     # All Epitran output
 	'all' : {
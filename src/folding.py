@@ -0,0 +1,104 @@
+""" Compiled folding dictionaries.
+
+The folding dictionaries in `dicts.py` are ordered lists of string replacements, applied one after another. Applying
+them with one `str.replace` per rule costs a pass over the line for every rule. Here, consecutive rules that cannot
+interact with each other are merged into a single regular expression, so that a dictionary is applied in a few passes
+that give exactly the same output as the ordered chain of replacements. Lines are also folded in batches, joined by
+newlines, so that each pass runs once over a whole batch rather than once per line.
+"""
+
+from functools import lru_cache
+import hashlib
+import re
+
+def _overlaps(a, b):
+    """ Returns True if occurrences of the strings `a` and `b` can overlap in some text. """
+
+    if a in b or b in a:
+        return True
+    for k in range(1, min(len(a), len(b))):
+        if a[-k:] == b[:k] or b[-k:] == a[:k]:
+            return True
+    return False
+
+def _group_rules(rules):
+    """ Splits an ordered list of (key, value) rules into groups that can each be applied in a single pass.
+
+    A rule can join the current group if its key cannot overlap the key or the value of any earlier rule in the
+    group. Then it never matches text that an earlier rule in the group consumed or produced, so replacing all of
+    the group's keys simultaneously is equivalent to replacing them one after another. A rule that deletes its key
+    closes the group, since the deletion could join text into a new match for a later rule.
+    """
+
+    groups = []
+    group = []
+    closed = False
+    for key, value in rules:
+        if group and (closed or any(_overlaps(key, k) or _overlaps(key, v) for k, v in group)):
+            groups.append(group)
+            group = []
+        group.append((key, value))
+        closed = value == ''
+    if group:
+        groups.append(group)
+    return groups
+
+class Folder:
+    """ Applies a folding dictionary to lines of text, giving the same output as applying each rule in order with `str.replace`. """
+
+    def __init__(self, folding):
+        """
+        Args:
+            folding (dict): An ordered mapping of strings to replace to their replacements.
+        """
+
+        rules = [(key, value) for key, value in folding.items() if key != '']
+        self.num_rules = len(rules)
+        self.batchable = not any('\n' in key or '\n' in value for key, value in rules)
+        self.passes = []
+        for group in _group_rules(rules):
+            if len(group) == 1:
+                self.passes.append(group[0])
+            else:
+                pattern = re.compile('|'.join(re.escape(key) for key, _ in group))
+                replacements = dict(group)
+                self.passes.append((pattern, lambda match, replacements=replacements: replacements[match.group()]))
+
+    def fold(self, line):
+        """ Applies the folding dictionary to a single line. """
+
+        for pattern, replacement in self.passes:
+            if isinstance(pattern, str):
+                line = line.replace(pattern, replacement)
+            else:
+                line = pattern.sub(replacement, line)
+        return line
+
+    def fold_lines(self, lines, pad=False):
+        """ Applies the folding dictionary to a list of lines, returning a new list.
+
+        If `pad` is True, each line is surrounded by spaces before folding (so that rules that start or end with a
+        space can match at the edges of the line) and stripped afterwards.
+        """
+
+        if pad:
+            lines = [' ' + line + ' ' for line in lines]
+        if self.batchable and not any('\n' in line for line in lines):
+            folded = self.fold('\n'.join(lines)).split('\n') if len(lines) > 0 else []
+        else:
+            folded = [self.fold(line) for line in lines]
+        if pad:
+            folded = [line.strip() for line in folded]
+        return folded
+
+@lru_cache(maxsize=None)
+def _compile_folder(rules):
+    return Folder(dict(rules))
+
+def get_folder(folding):
+    """ Returns the compiled `Folder` for a folding dictionary, compiling it on first use. """
+    return _compile_folder(tuple(folding.items()))
+
+def folding_hash(*foldings):
+    """ Returns a hash of the rules in one or more folding dictionaries, which changes whenever a rule is edited. """
+    return hashlib.sha256(repr([list(folding.items()) for folding in foldings]).encode('utf-8')).hexdigest()
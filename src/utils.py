@@ -1,12 +1,15 @@
 """ Utility functions for the project. """
 
+import hashlib
+import heapq
+import os
+
 def move_tone_marker_to_after_vowel(syll):
     """ Move the tone marker from the end of a cantonese syllable to directly after the vowel """
 
     cantonese_vowel_symbols = "eauɔiuːoɐɵyɛœĭŭiʊɪə"
     cantonese_tone_symbols = "˥˧˨˩"
     if not syll[-1] in cantonese_tone_symbols:
-        print(syll, syll[-1])
         return syll
     tone_marker = len(syll) - 1
     # Iterate backwards
@@ -18,22 +21,76 @@ def move_tone_marker_to_after_vowel(syll):
             return syll[:i+1] + syll[tone_marker:] + syll[i+1:tone_marker]
     return syll
 
-def move_tone_marker_to_after_vowel_line(line):
-    """ Move the tone marker from the end of a mandarin or cantonese syllable to directly after the vowel """
+TONE_SYMBOLS = ['˥', '˧˥', '˨˩', '˥˩', '˧', '˧˩̰', '˩˧', '˨', '˧˩̰', '˩˧', '˨˧', '˨˥']
+_TONE_SET = frozenset(TONE_SYMBOLS)
 
-    vowel_symbols = "eauɔiuːoɐɵyɛœĭŭiʊɪə"
-    tone_symbols = ['˥', '˧˥', '˨˩', '˥˩', '˧', '˧˩̰', '˩˧', '˨', '˧˩̰', '˩˧', '˨˧', '˨˥'] 
+def move_tone_markers(phonemes):
+    """ Moves each tone marker in a list of phonemes to directly after the preceding vowel, in place. """
+
+    vowel_symbols = "eauɔiuːoɐɵyɛœĭŭiʊɪə"
     last_marker = -1
-    line = line.split(' ')
-    for i in range(len(line)):
-        if line[i] in tone_symbols:
+    for i in range(len(phonemes)):
+        if phonemes[i] in _TONE_SET:
             for j in range(i-1, last_marker, -1):
-                if line[j] in vowel_symbols or line[j] in tone_symbols:
-                    line[j+1], line[i] = line[i], line[j+1]
+                if phonemes[j] in vowel_symbols or phonemes[j] in _TONE_SET:
+                    phonemes[j+1], phonemes[i] = phonemes[i], phonemes[j+1]
                     break
             last_marker = i
-    line = ' '.join(line)
-    # Combine tone markers with previous vowel
-    for tone in tone_symbols:
-        line = line.replace(' ' + tone, tone)
-    return line
+    return phonemes
+
+def attach_tone_markers(phonemes):
+    """ Returns a new list of phonemes, where each phoneme starting with a tone marker is combined with the phoneme
+    before it. A lone ˩ is only combined if the next phoneme starts with ˧ (forming ˩˧). """
+
+    attached = phonemes[:1]
+    for i in range(1, len(phonemes)):
+        phoneme = phonemes[i]
+        if phoneme.startswith(('˥', '˧', '˨', '˩˧')) or (phoneme == '˩' and i + 1 < len(phonemes) and phonemes[i+1].startswith('˧')):
+            attached[-1] += phoneme
+        else:
+            attached.append(phoneme)
+    return attached
+
+def move_tone_marker_to_after_vowel_line(line):
+    """ Move the tone marker from the end of a mandarin or cantonese syllable to directly after the vowel """
+
+    phonemes = move_tone_markers(line.split(' '))
+    if '' in phonemes:
+        # With empty phonemes (repeated spaces), each tone marker takes the spaces before it in turn
+        line = ' '.join(phonemes)
+        for tone in TONE_SYMBOLS:
+            line = line.replace(' ' + tone, tone)
+        return line
+    return ' '.join(attach_tone_markers(phonemes))
+
+def resolve_njobs(njobs):
+    """ Returns the number of parallel jobs to use, where a value below 1 means one job per CPU. """
+
+    if njobs < 1:
+        return os.cpu_count() or 1
+    return njobs
+
+def balanced_chunks(lines, num_chunks):
+    """ Splits the indices of `lines` into at most `num_chunks` chunks with roughly equal total character counts.
+
+    Lines are assigned longest first to the chunk with the fewest characters so far, so that one worker
+    does not receive all of the long lines. The indices within each chunk are in increasing order.
+    """
+
+    num_chunks = max(1, min(num_chunks, len(lines)))
+    heap = [(0, i) for i in range(num_chunks)]
+    chunks = [[] for _ in range(num_chunks)]
+    for index in sorted(range(len(lines)), key=lambda i: len(lines[i]), reverse=True):
+        size, chunk = heapq.heappop(heap)
+        chunks[chunk].append(index)
+        heapq.heappush(heap, (size + len(lines[index]) + 1, chunk))
+    return [sorted(chunk) for chunk in chunks if len(chunk) > 0]
+
+def file_hash(path):
+    """ Returns the sha256 hash of a file's contents. """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
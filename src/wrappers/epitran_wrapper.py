@@ -3,32 +3,144 @@
 import os
 import re
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
 
 from epitran import Epitran
 
+from .help import EPITRAN_KWARGS_HELP, EPITRAN_LANGUAGES_MESSAGE
 from .wrapper import Wrapper
+from ..cedict import load_cedict_trie
 from ..dicts import FOLDING_EPITRAN
-from ..utils import move_tone_marker_to_after_vowel_line
+from ..folding import get_folder
+from ..utils import balanced_chunks, move_tone_marker_to_after_vowel_line, resolve_njobs
+
+WHITESPACE_PATTERN = re.compile(r'\s+')
+PUNCTUATION_PATTERN = re.compile(r'[^\w\s]')
+DIGIT_PATTERN = re.compile(r'\d')
+
+# English pronunciations from Flite's lex_lookup, shared by all wrappers in the process. At most
+# MAX_ENGLISH_PRONUNCIATIONS words are kept, dropping the words looked up first.
+MAX_ENGLISH_PRONUNCIATIONS = 100_000
+_ENGLISH_PRONUNCIATIONS = {}
+
+def _remember_english_pronunciations(items):
+    """ Stores (word, pronunciation) pairs, dropping the oldest words once there are more than MAX_ENGLISH_PRONUNCIATIONS. """
+
+    _ENGLISH_PRONUNCIATIONS.update(items)
+    excess = len(_ENGLISH_PRONUNCIATIONS) - MAX_ENGLISH_PRONUNCIATIONS
+    if excess > 0:
+        for word in list(islice(_ENGLISH_PRONUNCIATIONS, excess)):
+            del _ENGLISH_PRONUNCIATIONS[word]
+
+@lru_cache(maxsize=None)
+def lex_lookup_available():
+    """ Checks once per process whether Flite's lex_lookup can be run. """
+
+    try:
+        subprocess.run(['lex_lookup', 'hello'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+def _memoize_english_g2p(english_g2p):
+    """ Wraps the `english_g2p` method of epitran's Flite backend, which runs lex_lookup once per word, so that
+    each word is only looked up once per process. Words are stored in lower case, since Flite lower-cases them. """
+
+    def cached_english_g2p(word):
+        word = word.lower()
+        pronunciation = _ENGLISH_PRONUNCIATIONS.get(word)
+        if pronunciation is None:
+            pronunciation = english_g2p(word)
+            _remember_english_pronunciations([(word, pronunciation)])
+        return pronunciation
+
+    cached_english_g2p.uncached = english_g2p
+    return cached_english_g2p
+
+# The wrapper of a worker process in the pool owned by an EpitranWrapper
+_worker_wrapper = None
+
+def _init_epitran_worker(language, keep_word_boundaries):
+    """ Initializes a worker process with its own wrapper and Epitran instance, which are reused for every chunk sent to the worker. """
+
+    global _worker_wrapper
+    _worker_wrapper = EpitranWrapper(language, keep_word_boundaries, eager=True, njobs=1)
+
+def _phonemize_epitran_chunk(lines):
+    """ Phonemizes a chunk of lines with the wrapper of a worker process. """
+    return _worker_wrapper._phonemize_serial(lines)
 
 class EpitranWrapper(Wrapper):
 
     # TODO: Check support from epitran library instead of hardcoding.
     # See https://github.com/dmort27/epitran#language-support
     SUPPORTED_LANGUAGES = ['aar-Latn', 'aii-Syrc', 'amh-Ethi', 'amh-Ethi-pp', 'amh-Ethi-red', 'ara-Arab', 'ava-Cyrl', 'aze-Cyrl', 'aze-Latn', 'ben-Beng', 'ben-Beng-red', 'bxk-Latn', 'cat-Latn', 'ceb-Latn', 'ces-Latn', 'cjy-Latn', 'cmn-Hans', 'cmn-Hant', 'cmn-Latn', 'ckb-Arab', 'csb-Latn', 'deu-Latn', 'deu-Latn-np', 'deu-Latn-nar', 'eng-Latn', 'epo-Latn', 'fas-Arab', 'fra-Latn', 'fra-Latn-np', 'fra-Latn-p', 'ful-Latn', 'gan-Latn', 'got-Latn', 'hak-Latn', 'hau-Latn', 'hin-Deva', 'hmn-Latn', 'hrv-Latn', 'hsn-Latn', 'hun-Latn', 'ilo-Latn', 'ind-Latn', 'ita-Latn', 'jam-Latn', 'jav-Latn', 'kaz-Cyrl', 'kaz-Cyrl-bab', 'kaz-Latn', 'kbd-Cyrl', 'khm-Khmr', 'kin-Latn', 'kir-Arab', 'kir-Cyrl', 'kir-Latn', 'kmr-Latn', 'kmr-Latn-red', 'kor-Hang', 'lao-Laoo', 'lij-Latn', 'lsm-Latn', 'ltc-Latn-bax', 'mal-Mlym', 'mar-Deva', 'mlt-Latn', 'mon-Cyrl-bab', 'mri-Latn', 'msa-Latn', 'mya-Mymr', 'nan-Latn', 'nan-Latn-tl', 'nld-Latn', 'nya-Latn', 'ood-Lat-alv', 'ood-Latn-sax', 'ori-Orya', 'orm-Latn', 'pan-Guru', 'pol-Latn', 'por-Latn', 'quy-Latn', 'ron-Latn', 'run-Latn', 'rus-Cyrl', 'sag-Latn', 'sin-Sinh', 'sna-Latn', 'som-Latn', 'spa-Latn', 'spa-Latn-red', 'sqi-Latn', 'srp-Latn', 'swa-Latn', 'swa-Latn', 'swe-Latn', 'tam-Taml-red', 'tam-Taml', 'tel-Telu', 'tgk-Cyrl', 'tgl-Latn-red', 'tgl-Latn', 'tha-Thai', 'tir-Ethi', 'tir-Ethi-pp', 'tir-Ethi-red', 'tpi-Latn', 'tuk-Cyrl', 'tuk-Latn', 'tur-Latn', 'tur-Latn-bab', 'tur-Latn-red', 'ukr-Cyrl', 'urd-Arab', 'uig-Arab', 'uzb-Cyrl', 'uzb-Latn', 'vie-Latn', 'wuu-Latn', 'xho-Latn', 'yor-Latn', 'yue-Latn', 'zha-Latn', 'zul-Latn']
+    BACKEND_PACKAGE = 'epitran'
+
+    WRAPPER_KWARGS_TYPES = {
+        **Wrapper.WRAPPER_KWARGS_TYPES,
+        'njobs': int,
+        'parallel_threshold': int,
+    }
+
+    WRAPPER_KWARGS_DEFAULTS = {
+        **Wrapper.WRAPPER_KWARGS_DEFAULTS,
+        'njobs': 4,
+        'parallel_threshold': 1000,
+    }
+
+    KWARGS_HELP = EPITRAN_KWARGS_HELP
+
+    EXECUTION_KWARGS = ['njobs', 'parallel_threshold']
     CEDICT = os.path.join(os.path.dirname(__file__), '../../data/cedict_ts.u8')
 
     @staticmethod
     def supported_languages_message():
-        message = 'The EpitranWrapper uses the epitran library, which supports multiple backends.\n'
-        message += 'For a list of supported languages, see https://github.com/dmort27/epitran#language-support\n'
-        return message
+        return EPITRAN_LANGUAGES_MESSAGE
+
+    def __init__(self, language, keep_word_boundaries=True, verbose=False, use_folding=True, eager=False, **wrapper_kwargs):
+        """
+        Args:
+            eager (bool): Whether to build the Epitran instance straight away, rather than on first use.
+            See `Wrapper.__init__` for the other arguments.
+        """
 
-    def __init__(self, language, keep_word_boundaries=True, verbose=False, use_folding=True, **wrapper_kwargs):
         super().__init__(language, keep_word_boundaries, verbose, use_folding, **wrapper_kwargs)
         self.norm_punc = False
         self.ligatures = False
-        self.epi = Epitran(self.language, tones=True, cedict_file=self.CEDICT, ligatures=self.ligatures)
-        
+        self.njobs = resolve_njobs(self.njobs)
+
+        # The Epitran instance and the pool of worker processes are created on first use and kept for the lifetime of the wrapper
+        self._epi = None
+        self._pool = None
+        if eager:
+            self.load()
+
+    def load(self):
+        """ Builds the Epitran instance, if it has not been built yet. For Mandarin, CEDICT is loaded from a
+        memory-mapped index (see `load_cedict_trie`). """
+
+        if self._epi is not None:
+            return
+        if self.language in ['cmn-Hans', 'cmn-Hant']:
+            # Build with an empty dictionary and swap in the memory-mapped CEDICT index, instead of parsing CEDICT
+            self._epi = Epitran(self.language, tones=True, cedict_file=os.devnull, ligatures=self.ligatures)
+            self._epi.epi.cedict = load_cedict_trie(os.path.abspath(self.CEDICT), traditional=self.language == 'cmn-Hant')
+        else:
+            self._epi = Epitran(self.language, tones=True, cedict_file=self.CEDICT, ligatures=self.ligatures)
+        if self.language == 'eng-Latn':
+            self._epi.epi.english_g2p = _memoize_english_g2p(self._epi.epi.english_g2p)
+
+    @property
+    def epi(self):
+        """ The Epitran instance, built on first use (see `load`) since loading it can take several seconds (e.g. to
+        parse CEDICT). This means that refolding saved output does not have to load it at all. """
+
+        self.load()
+        return self._epi
+
     def check_language_support(self, language):
         """ Checks if the language is supported by the wrapper. """
         
@@ -41,72 +153,136 @@ class EpitranWrapper(Wrapper):
                     return False
             elif language == 'eng-Latn':
                 # Try running lex_lookup on the system
-                try:
-                    subprocess.run(['lex_lookup', 'hello'], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                except subprocess.CalledProcessError:
+                if not lex_lookup_available():
                     self.logger.error('Epitran requires Flite to be installed. Please install Flite and ensure that lex_lookup is in your system PATH. Instructions at https://github.com/dmort27/epitran#installation-of-flite-for-english-g2p')
                     return False
             return True
         return False
 
-    def phonemize(self, lines):
-        """ Uses epitram to phonemize text. Returns a list of phonemized lines. Lines that could not be phonemized are returned as empty strings."""
+    def folding_dicts(self):
+        return [FOLDING_EPITRAN['all'], FOLDING_EPITRAN.get(self.language, {})]
+
+    def data_files(self):
+        # Epitran only reads CEDICT for Mandarin in Chinese characters
+        return [self.CEDICT] if self.language in ['cmn-Hans', 'cmn-Hant'] else []
+
+    def _phonemize(self, lines):
+        """ Uses epitram to phonemize text. Returns the words of phonemes of each line.
+
+        Batches smaller than `parallel_threshold` are phonemized serially. Larger batches are split into `njobs`
+        chunks with roughly equal numbers of characters, which are sent to a pool of worker processes that each hold
+        their own Epitran instance, and reassembled in order. English is always phonemized serially, since its cost
+        is in the lex_lookup processes, which are already run concurrently (see `_prefetch_english_words`).
+        """
 
         self.logger.debug(f'Using epitram backend with language code "{self.language}"...')
-        
+
+        if self.njobs == 1 or len(lines) < self.parallel_threshold or self.language == 'eng-Latn':
+            return self._phonemize_serial(lines)
+
+        if self._pool is None:
+            self.logger.debug(f'Starting {self.njobs} epitran worker processes.')
+            self._pool = ProcessPoolExecutor(max_workers=self.njobs, initializer=_init_epitran_worker, initargs=(self.language, self.keep_word_boundaries))
+
+        chunks = balanced_chunks(lines, self.njobs)
+        self.logger.debug(f'Phonemizing {len(lines)} lines in {len(chunks)} parallel jobs.')
+        phonemized_lines = [None] * len(lines)
+        futures = [self._pool.submit(_phonemize_epitran_chunk, [lines[i] for i in chunk]) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            for i, line in zip(chunk, future.result()):
+                phonemized_lines[i] = line
+
+        return phonemized_lines
+
+    def _phonemize_serial(self, lines):
+        """ Phonemizes lines one by one with the wrapper's Epitran instance. """
+
+        # Replace duplicate whitespace with single space and strip punctuation
+        lines = [PUNCTUATION_PATTERN.sub('', WHITESPACE_PATTERN.sub(' ', line).strip()) for line in lines]
+        if self.language == 'eng-Latn':
+            self._prefetch_english_words(lines)
+
         phonemized_lines = []
         for line in lines:
-            # Replace duplicate whitespace with single space and strip punctuation
-            line = re.sub(r'\s+', ' ', line).strip()
-            line = re.sub(r'[^\w\s]', '', line)
-
             if self.language == 'yue-Latn':
-                line = self._phonemize_yue_latn(line)
+                phonemized_lines.append(self._phonemize_yue_latn(line))
             else:
-                line = self.epi.trans_delimiter(line + ' ', delimiter='PHONE_BOUNDARY', normpunc=self.norm_punc, ligatures=self.ligatures)
-                line = line.replace('PHONE_BOUNDARY ', ' WORD_BOUNDARY' if self.keep_word_boundaries else '')
-                line = line.replace('WORD_BOUNDARY WORD_BOUNDARY', 'WORD_BOUNDARY')
-                line = line.replace('PHONE_BOUNDARY', ' ')
-            phonemized_lines.append(line)
-
-        if self.use_folding:
-            phonemized_lines = self._post_process_epitran_output(phonemized_lines)
-        else:
-            self.logger.debug("Skipping folding dictionary post-processing, using uncorrected output from epitran.")
+                phonemized_lines.append(self._split_words(self.epi.trans_delimiter(line + ' ', delimiter='PHONE_BOUNDARY', normpunc=self.norm_punc, ligatures=self.ligatures)))
 
         return phonemized_lines
-    
+
+    def _split_words(self, line):
+        """ Splits a line transcribed by epitran into words of phonemes. Spaces are transcribed as segments of their
+        own, which separate the words; words without phonemes (between repeated spaces) are dropped. """
+
+        words = []
+        word = []
+        for segment in line.split('PHONE_BOUNDARY'):
+            if segment != ' ':
+                word.append(segment)
+            elif len(word) > 0:
+                words.append(word)
+                word = []
+        if len(word) > 0:
+            words.append(word)
+        return words
+
+    def _word_end(self):
+        # Without word boundaries, each Cantonese word is followed by an empty phoneme (an extra space)
+        if self.language == 'yue-Latn' and not self.keep_word_boundaries:
+            return ['']
+        return super()._word_end()
+
+    def close(self):
+        """ Shuts down the pool of epitran worker processes, if one was started, and forgets the English
+        pronunciations looked up so far. """
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        _ENGLISH_PRONUNCIATIONS.clear()
+
+    def _prefetch_english_words(self, lines):
+        """ Looks up the English words in `lines` that have not been seen before concurrently, since Flite's
+        lex_lookup is run as a separate process for each word. """
+
+        flite = self.epi.epi
+        words = {chunk.lower() for line in lines for chunk in flite.chunk_re.findall(line) if flite.letter_re.match(chunk)}
+        words = [word for word in words if word not in _ENGLISH_PRONUNCIATIONS]
+        if len(words) == 0:
+            return
+        self.logger.debug(f'Looking up {len(words)} new English words with lex_lookup...')
+        with ThreadPoolExecutor() as executor:
+            pronunciations = list(executor.map(flite.english_g2p.uncached, words))
+        _remember_english_pronunciations(zip(words, pronunciations))
+
     def _phonemize_yue_latn(self, line):
         # For Cantonese, there is a bug in epitran that causes it not to recognise tone marks
         # unless they are at the end of the word, so we must split the word by syllable.
         words = [word for word in line.split()]
-        words = [re.sub(r'\d', lambda x: x.group() + '_', word) for word in words]
+        words = [DIGIT_PATTERN.sub(lambda x: x.group() + '_', word) for word in words]
         words = [word.split('_')[:-1] for word in words]
-        words = [[self.epi.trans_delimiter(syll, normpunc=self.norm_punc, ligatures=self.ligatures).strip() for syll in word] for word in words]
-        words = [' '.join(word) for word in words]
-        words = [word.strip() + (' WORD_BOUNDARY' if self.keep_word_boundaries else ' ') for word in words]
-        line = ' '.join(words)
-        return line
+        words = [[self.epi.trans_delimiter(syll, normpunc=self.norm_punc, ligatures=self.ligatures).split() for syll in word] for word in words]
+        # A word without syllables is kept as an empty phoneme, so that it still gets a word boundary
+        return [[phoneme for syll in word for phoneme in syll] or [''] for word in words]
 
-    def _post_process_epitran_output(self, lines):
-        """ Removes phone boundary markers, adds word boundary markers, removes extra spaces and corrects general espeak output. """
+    def _fold(self, lines):
+        """ Corrects epitran output with the folding dictionaries and moves tone markers to after the vowel for Chinese. """
 
         if self.language not in FOLDING_EPITRAN:
             self.logger.debug(f'No folding dictionary found for language code: "{self.language}".')
         else:
             self.logger.debug(f'Applying folding dictionary for language code: "{self.language}".')
 
-        for i in range(len(lines)):
-            if lines[i] == '' or lines[i] == ' ':
-                continue
-            for key, value in FOLDING_EPITRAN['all'].items():
-                lines[i] = lines[i].replace(key, value)
-            if self.language in FOLDING_EPITRAN:
-                lines[i] = ' ' + lines[i] + ' ' # For matching folding dictionary items that end or start with a space
-                for key, value in FOLDING_EPITRAN[self.language].items():
-                    lines[i] = lines[i].replace(key, value)
-                lines[i] = lines[i].strip()
-            if self.language in ['cmn-Hans', 'cmn-Hant', 'cmn-Latn', 'yue-Latn']:
-                lines[i] = move_tone_marker_to_after_vowel_line(lines[i])
+        indices = [i for i in range(len(lines)) if lines[i] != '' and lines[i] != ' ']
+        folded = get_folder(FOLDING_EPITRAN['all']).fold_lines([lines[i] for i in indices])
+        if self.language in FOLDING_EPITRAN:
+            # Pad lines for matching folding dictionary items that end or start with a space
+            folded = get_folder(FOLDING_EPITRAN[self.language]).fold_lines(folded, pad=True)
+        if self.language in ['cmn-Hans', 'cmn-Hant', 'cmn-Latn', 'yue-Latn']:
+            folded = [move_tone_marker_to_after_vowel_line(line) for line in folded]
+
+        for i, line in zip(indices, folded):
+            lines[i] = line
 
         return lines
@@ -0,0 +1,44 @@
+""" Help text for each backend's wrapper, kept apart from the wrappers so that `g2pp.py --help` can print it without
+importing the backend libraries. """
+
+COMMON_KWARGS_HELP = {
+    'lexicon_mode': 'Phonemize each word type once and rebuild utterances from the per-word results.',
+}
+
+EPITRAN_LANGUAGES_MESSAGE = (
+    'The EpitranWrapper uses the epitran library, which supports multiple backends.\n'
+    'For a list of supported languages, see https://github.com/dmort27/epitran#language-support\n'
+)
+
+EPITRAN_KWARGS_HELP = {
+    **COMMON_KWARGS_HELP,
+    'njobs': 'Maximum number of epitran processes to run in parallel (0 for one per CPU).',
+    'parallel_threshold': 'Minimum number of lines for which epitran is run in parallel (smaller batches are phonemized serially).',
+}
+
+PHONEMIZER_LANGUAGES_MESSAGE = (
+    'The PhonemizerWrapper uses the phonemizer library, which supports multiple backends.\n'
+    'For Japanese (language="ja"), the segments backend is used.\n'
+    'For all other languages, the espeak-ng backend, which supports over 127 languages and accents.\n'
+    'For a list of supported languages, run `espeak-ng --voices` or see https://github.com/espeak-ng/espeak-ng/blob/master/docs/languages.md\n'
+)
+
+PHONEMIZER_KWARGS_HELP = {
+    **COMMON_KWARGS_HELP,
+    'allow_possibly_faulty_word_boundaries': 'Allow possibly faulty word boundaries (otherwise removes lines with mismatched word boundaries).',
+    'preserve_punctuation': 'Preserve punctuation.',
+    'njobs': 'Maximum number of espeak processes to run in parallel (0 for one per CPU).',
+    'parallel_threshold': 'Minimum number of lines for which espeak is run in parallel (smaller batches are phonemized serially).',
+}
+
+PINGYAM_LANGUAGES_MESSAGE = 'The PingyamWrapper uses the pingyam library, which only supports `cantonese`.\n'
+
+PINYIN_TO_IPA_LANGUAGES_MESSAGE = 'The PinyinToIpaWrapper uses the pinyin_to_ipa library, which only supports `mandarin`.\n'
+
+# Supported languages message and help for additional arguments of each backend in `g2pp.WRAPPER_BACKENDS`
+BACKEND_HELP = {
+    'epitran': (EPITRAN_LANGUAGES_MESSAGE, EPITRAN_KWARGS_HELP),
+    'phonemizer': (PHONEMIZER_LANGUAGES_MESSAGE, PHONEMIZER_KWARGS_HELP),
+    'pingyam': (PINGYAM_LANGUAGES_MESSAGE, COMMON_KWARGS_HELP),
+    'pinyin_to_ipa': (PINYIN_TO_IPA_LANGUAGES_MESSAGE, COMMON_KWARGS_HELP),
+}
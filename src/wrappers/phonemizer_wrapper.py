@@ -1,39 +1,79 @@
 """ Wrapper for the phonemizer library. """
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 import logging
 import os
-import re
-import subprocess
-from phonemizer import phonemize
+from phonemizer.backend import EspeakBackend, SegmentsBackend
 from phonemizer.separator import Separator
 
 from ..dicts import FOLDING_PHONEMIZER
+from ..folding import get_folder
+from ..utils import balanced_chunks, resolve_njobs
+from .help import PHONEMIZER_KWARGS_HELP, PHONEMIZER_LANGUAGES_MESSAGE
 from .wrapper import Wrapper
 
+@lru_cache(maxsize=None)
+def _espeak_languages(library):
+    """ Returns the languages of the voices available in an espeak-ng library, queried once per process. """
+
+    try:
+        return tuple(EspeakBackend.supported_languages().keys())
+    except RuntimeError:
+        logging.getLogger(__name__).error(f'Could not load the espeak-ng library at {library}. Please install espeak-ng.')
+        return ()
+
+# The espeak backend of a worker process in the pool owned by a PhonemizerWrapper
+_worker_backend = None
+
+def _init_espeak_worker(language, backend_kwargs):
+    """ Initializes a worker process with an espeak backend, which is reused for every chunk sent to the worker. """
+
+    global _worker_backend
+    logging.disable(logging.WARNING)
+    _worker_backend = EspeakBackend(language, **backend_kwargs)
+
+def _phonemize_espeak_chunk(lines, separator, strip):
+    """ Phonemizes a chunk of lines with the espeak backend of a worker process. """
+    return _phonemize_with_backend(_worker_backend, lines, separator, strip)
+
+def _phonemize_with_backend(backend, lines, separator, strip):
+    """ Phonemizes lines with an espeak backend, returning empty strings for empty lines. """
+
+    phn = [''] * len(lines)
+    indices = [i for i in range(len(lines)) if lines[i].strip() != '']
+    if len(indices) > 0:
+        for i, line in zip(indices, backend.phonemize([lines[i] for i in indices], separator=separator, strip=strip, njobs=1)):
+            phn[i] = line
+    return phn
+
 class PhonemizerWrapper(Wrapper):
 
+    BACKEND_PACKAGE = 'phonemizer'
+
     WRAPPER_KWARGS_TYPES = {
+        **Wrapper.WRAPPER_KWARGS_TYPES,
         'allow_possibly_faulty_word_boundaries': bool,
         'preserve_punctuation': bool,
+        'njobs': int,
+        'parallel_threshold': int,
     }
 
     WRAPPER_KWARGS_DEFAULTS = {
+        **Wrapper.WRAPPER_KWARGS_DEFAULTS,
         'allow_possibly_faulty_word_boundaries': False,
         'preserve_punctuation': False,
+        'njobs': 4,
+        'parallel_threshold': 1000,
     }
 
-    KWARGS_HELP = {
-        'allow_possibly_faulty_word_boundaries': 'Allow possibly faulty word boundaries (otherwise removes lines with mismatched word boundaries).',
-        'preserve_punctuation': 'Preserve punctuation.',
-    }
+    KWARGS_HELP = PHONEMIZER_KWARGS_HELP
+
+    EXECUTION_KWARGS = ['njobs', 'parallel_threshold']
 
     @staticmethod
     def supported_languages_message():
-        message = 'The PhonemizerWrapper uses the phonemizer library, which supports multiple backends.\n'
-        message += 'For Japanese (language="ja"), the segments backend is used.\n'
-        message += 'For all other languages, the espeak-ng backend, which supports over 127 languages and accents.\n'
-        message += 'For a list of supported languages, run `espeak-ng --voices` or see https://github.com/espeak-ng/espeak-ng/blob/master/docs/languages.md\n'
-        return message
+        return PHONEMIZER_LANGUAGES_MESSAGE
 
     def __init__(self, language, keep_word_boundaries=True, verbose=False, use_folding=True, **wrapper_kwargs):
         super().__init__(language, keep_word_boundaries, verbose, use_folding, **wrapper_kwargs)
@@ -42,9 +82,15 @@ class PhonemizerWrapper(Wrapper):
         self.language_switch = 'remove-utterance'
 
         # This setting removes utterances that the backend produces with a different number of words.
-        # If we are not keeping word boundaries, this does not matter.
-        self.words_mismatch = 'ignore' if self.allow_possibly_faulty_word_boundaries or not self.keep_word_boundaries else 'remove'
-        self.njobs = 4
+        # If we are not keeping word boundaries, this does not matter. In lexicon mode, each utterance
+        # is a single word and word boundaries are placed by the wrapper, so mismatches are ignored.
+        self.words_mismatch = 'ignore' if self.allow_possibly_faulty_word_boundaries or not self.keep_word_boundaries or self.lexicon_mode else 'remove'
+        self.njobs = resolve_njobs(self.njobs)
+
+        # The backends and the pool of worker processes are created on first use and kept for the lifetime of the wrapper
+        self._backend = None
+        self._segments_backend = None
+        self._pool = None
 
     def check_language_support(self, language):
         """ Checks if the language is supported by the wrapper. """
@@ -54,101 +100,145 @@ class PhonemizerWrapper(Wrapper):
         # Check if PHONEMIZER_ESPEAK_LIBRARY is set
         if os.getenv('PHONEMIZER_ESPEAK_LIBRARY') is None:
             raise ValueError('PHONEMIZER_ESPEAK_LIBRARY is not set. Please set it to the path of the espeak-ng library. See README.md for more information.')
-        if language in self.get_supported_languages():
-            return True
-        return False
-        
-    def get_supported_languages(self):
-        """ Returns a list of supported languages for the wrapper. """
-        try:
-            output = subprocess.run(['espeak-ng', '--voices'], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode('utf-8')
-            languages = [re.sub(r'\s+', ' ', l.strip()).split(' ')[1] for l in output.strip().split('\n')][1:]
-            return languages
-        except subprocess.CalledProcessError:
-            self.logger.error('Phonemizer requires espeak-ng to be installed. Please install espeak-ng.')
-            return []
-        
-    def phonemize(self, lines):
-        """ Uses phonemizer to phonemize text. Returns a list of phonemized lines. Lines that could not be phonemized are returned as empty strings."""
+        return language in _espeak_languages(os.getenv('PHONEMIZER_ESPEAK_LIBRARY'))
+
+    @classmethod
+    def list_languages(cls):
+        """ Returns the languages of the espeak-ng voices (from the library that phonemizer uses, queried once per
+        process) and `ja`, which uses the segments backend. """
+
+        if os.getenv('PHONEMIZER_ESPEAK_LIBRARY') is None:
+            return ['ja']
+        return ['ja'] + list(_espeak_languages(os.getenv('PHONEMIZER_ESPEAK_LIBRARY')))
+
+    def backend_version(self):
+        """ Returns the version of phonemizer and, unless the segments backend is used, of espeak-ng. """
+
+        version = super().backend_version()
+        if self.language == 'ja':
+            return version
+        return f'{version}, espeak-ng {".".join(str(v) for v in EspeakBackend.version())}'
+
+    def folding_dicts(self):
+        return [FOLDING_PHONEMIZER['all'], FOLDING_PHONEMIZER.get(self.language, {})]
+
+    def _phonemize(self, lines):
+        """ Uses phonemizer to phonemize text. Returns the words of phonemes of each line. Lines that could not be phonemized are returned as None."""
         if self.language == 'ja':
             # Japanese is not supported by espeak, so we use the segments backend.
             phonemized_lines = self._phonemize_japanese(lines)
         else:
             phonemized_lines = self._phonemize_utterances(lines)
 
-        phonemized_lines = self._post_process_phonemizer_output(phonemized_lines)
-
-        return phonemized_lines
+        return self._split_words(phonemized_lines)
 
     def _phonemize_japanese(self, lines):
         """ Uses phonemizer with segments backend to phonemize Japanese text."""
 
         self.logger.debug('Using the segments backend to phonemize Japanese text.')
-        phn = []
-        missed_lines = 0
-        for line in lines:
-            try:
-                phn.append(phonemize(
-                    line,
-                    language='japanese',
-                    backend='segments',
-                    separator=self.separator,
-                    strip=self.strip,
-                    preserve_punctuation=self.preserve_punctuation)) 
-            except ValueError:
-                missed_lines += 1
-                phn.append('')
+        if self._segments_backend is None:
+            self._segments_backend = SegmentsBackend('japanese', preserve_punctuation=self.preserve_punctuation)
+        phn, missed_lines = self._phonemize_segments_batch(lines)
         if missed_lines > 0:
             self.logger.debug(f'{missed_lines} lines were not phonemized due to errors with the segments file.')
 
         return phn
+
+    def _phonemize_segments_batch(self, lines):
+        """ Phonemizes a batch of lines with the segments backend, returning the phonemized lines and the number of lines that failed.
+
+        The segments backend raises a ValueError for the whole batch if any line contains characters that are not
+        in its profile. In that case the batch is split in halves, recursively, so that only the failing lines
+        are returned as empty strings.
+        """
+
+        try:
+            return _phonemize_with_backend(self._segments_backend, lines, self.separator, self.strip), 0
+        except ValueError:
+            if len(lines) == 1:
+                return [''], 1
+            middle = len(lines) // 2
+            left, left_missed = self._phonemize_segments_batch(lines[:middle])
+            right, right_missed = self._phonemize_segments_batch(lines[middle:])
+            return left + right, left_missed + right_missed
     
+    def _backend_kwargs(self):
+        return {
+            'preserve_punctuation': self.preserve_punctuation,
+            'language_switch': self.language_switch,
+            'words_mismatch': self.words_mismatch,
+        }
+
     def _phonemize_utterances(self, lines):
-        """ Uses phonemizer with the espeak backend to phonemize text. """
+        """ Uses phonemizer with the espeak backend to phonemize text.
+
+        Batches smaller than `parallel_threshold` are phonemized serially with an espeak backend owned by the
+        wrapper. Larger batches are split into `njobs` chunks with roughly equal numbers of characters, which are
+        sent to a pool of worker processes that each hold their own espeak backend, and reassembled in order.
+        The backend and the pool are created once and reused by later calls.
+        """
         
         self.logger.debug(f'Using espeak backend with language code "{self.language}"...')
-        logging.disable(logging.WARNING)
-        phn = phonemize(
-            lines,
-            language=self.language,
-            backend='espeak',
-            separator=self.separator,
-            strip=self.strip,
-            preserve_punctuation=self.preserve_punctuation,
-            language_switch=self.language_switch,
-            words_mismatch=self.words_mismatch,
-            njobs=self.njobs)
-        logging.disable(logging.NOTSET)
+
+        if self.njobs == 1 or len(lines) < self.parallel_threshold:
+            # Silence the backend's warnings, making sure logging is re-enabled even if the backend fails, since the
+            # wrapper (and the process) may be used again
+            logging.disable(logging.WARNING)
+            try:
+                if self._backend is None:
+                    self._backend = EspeakBackend(self.language, **self._backend_kwargs())
+                return _phonemize_with_backend(self._backend, lines, self.separator, self.strip)
+            finally:
+                logging.disable(logging.NOTSET)
+
+        if self._pool is None:
+            self.logger.debug(f'Starting {self.njobs} espeak worker processes.')
+            self._pool = ProcessPoolExecutor(max_workers=self.njobs, initializer=_init_espeak_worker, initargs=(self.language, self._backend_kwargs()))
+
+        chunks = balanced_chunks(lines, self.njobs)
+        self.logger.debug(f'Phonemizing {len(lines)} lines in {len(chunks)} parallel jobs.')
+        phn = [''] * len(lines)
+        futures = [self._pool.submit(_phonemize_espeak_chunk, [lines[i] for i in chunk], self.separator, self.strip) for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            for i, line in zip(chunk, future.result()):
+                phn[i] = line
         
         return phn
 
-    def _post_process_phonemizer_output(self, lines):
-        """ Removes phone boundary markers, adds word boundary markers, removes extra spaces and corrects general espeak output. """
+    def close(self):
+        """ Shuts down the pool of espeak worker processes, if one was started. """
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _split_words(self, lines):
+        """ Splits the output of the backend at the word and phone separators into words of phonemes. Empty phonemes
+        are kept, so that the serialized line is the same as the output of the backend. """
+
+        return [None if line.strip() == '' else [word.split('PHONE_BOUNDARY') for word in line.split(' ')] for line in lines]
+
+    def _fold(self, lines):
+        """ Removes extra spaces and corrects general espeak output with the folding dictionaries. """
 
-        if self.language not in FOLDING_PHONEMIZER and self.use_folding:
+        if self.language not in FOLDING_PHONEMIZER:
             self.logger.debug(f'No folding dictionary found for language code: "{self.language}".')
-        elif self.use_folding:
-            self.logger.debug(f'Applying folding dictionary for language code: "{self.language}".')
         else:
-            self.logger.debug("Skipping folding dictionary post-processing, using uncorrected output from phonemizer.")
-
-        for i in range(len(lines)):
-            if lines[i] == '' or lines[i] == ' ':
-                continue
-            if self.keep_word_boundaries:
-                lines[i] = lines[i].replace(' ', ' WORD_BOUNDARY ')
-            lines[i] = lines[i].replace('PHONE_BOUNDARY', ' ')
-
-            if self.use_folding:
-                for key, value in FOLDING_PHONEMIZER['all'].items():
-                    lines[i] = lines[i].replace(key, value)
-                if self.language in FOLDING_PHONEMIZER:
-                    lines[i] = ' ' + lines[i] + ' ' # For matching folding dictionary items that end or start with a space
-                    for key, value in FOLDING_PHONEMIZER[self.language].items():
-                        lines[i] = lines[i].replace(key, value)
-                lines[i] = lines[i].strip()
-
-            if self.keep_word_boundaries:
-                lines[i] = lines[i] + ' WORD_BOUNDARY'
+            self.logger.debug(f'Applying folding dictionary for language code: "{self.language}".')
+
+        # The final word boundary is removed while folding, so that folding items ending with a space match the end of the line
+        indices = [i for i in range(len(lines)) if lines[i] != '' and lines[i] != ' ']
+        to_fold = [lines[i] for i in indices]
+        if self.keep_word_boundaries:
+            to_fold = [line[:-len(' WORD_BOUNDARY')] if line.endswith(' WORD_BOUNDARY') else line for line in to_fold]
+
+        to_fold = get_folder(FOLDING_PHONEMIZER['all']).fold_lines(to_fold)
+        if self.language in FOLDING_PHONEMIZER:
+            # Pad lines for matching folding dictionary items that end or start with a space
+            to_fold = get_folder(FOLDING_PHONEMIZER[self.language]).fold_lines(to_fold, pad=True)
+
+        for i, line in zip(indices, to_fold):
+            line = line.strip()
+            lines[i] = line + ' WORD_BOUNDARY' if self.keep_word_boundaries else line
 
         return lines
@@ -1,14 +1,53 @@
 """ Wrapper for pingyam library for converting Cantonese  to IPA. """
 
+import csv
 import os
-import pandas as pd
 import re
+from functools import lru_cache
 
-from ..dicts import FOLDING_PINGYAM
+from ..dicts import FOLDING_PINGYAM, FOLDING_PINGYAM_JUNCTIONS
+from ..folding import get_folder
+from .help import PINGYAM_LANGUAGES_MESSAGE
 from .wrapper import Wrapper
 from ..utils import move_tone_marker_to_after_vowel
 
 PINGYAM_PATH = os.path.join(os.path.dirname(__file__), '../../data/pingyam/pingyambiu')
+SYLLABLE_PATTERN = re.compile(r'[a-zA-Z]+[0-9]*')
+TONE_MARKERS = '˥˧˨˩'
+
+@lru_cache(maxsize=None)
+def load_syllable_table(path=PINGYAM_PATH):
+    """ Loads the pingyam database once per process, mapping each jyutping syllable to its IPA transcription.
+
+    The tone marker of each syllable is moved to after the vowel and the syllable is split into a tuple of its
+    characters, ready to be joined into a line and corrected by `FOLDING_PINGYAM`. Rows that are not jyutping syllables, such as
+    the header, are skipped since they can never be looked up.
+    """
+
+    table = {}
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.reader(f, delimiter='\t'):
+            if len(row) <= 6 or not SYLLABLE_PATTERN.fullmatch(row[6]):
+                continue
+            ipa = row[5]
+            if ipa != '' and ipa[-1] in TONE_MARKERS:
+                ipa = move_tone_marker_to_after_vowel(ipa)
+            table[row[6]] = tuple(ipa)
+    return table
+
+@lru_cache(maxsize=None)
+def load_folded_syllable_table(path=PINGYAM_PATH):
+    """ Maps each jyutping syllable to a tuple of its phonemes corrected by `FOLDING_PINGYAM`, with the tone markers
+    attached to the vowels. Built once per process from `load_syllable_table`.
+
+    Folding each syllable on its own gives the same phonemes as folding whole lines, except at the joins between the
+    syllables of a word, which are corrected with `FOLDING_PINGYAM_JUNCTIONS`.
+    """
+
+    table = load_syllable_table(path)
+    syllables = list(table)
+    folded = get_folder(FOLDING_PINGYAM).fold_lines([' '.join(table[syllable]) for syllable in syllables])
+    return {syllable: tuple(line.split(' ')) if line != '' else () for syllable, line in zip(syllables, folded)}
 
 class PingyamWrapper(Wrapper):
 
@@ -16,68 +55,85 @@ class PingyamWrapper(Wrapper):
 
     @staticmethod
     def supported_languages_message():
-        message = 'The PingyamWrapper uses the pingyam library, which only supports `cantonese`.\n'
-        return message
+        return PINGYAM_LANGUAGES_MESSAGE
     
-    def phonemize(self, lines):
+    def folding_dicts(self):
+        return [FOLDING_PINGYAM]
+
+    def data_files(self):
+        return [PINGYAM_PATH]
+
+    def _phonemize(self, lines):
         """ Uses pingyam library to convert Cantonese from jyutping to IPA. """
+        return self._phonemize_syllables(lines, load_syllable_table())
+
+    def _phonemize_folded(self, lines):
+        """ Converts Cantonese from jyutping to folded IPA with the folded syllable table, joining the phonemes at the
+        junctions between syllables with `FOLDING_PINGYAM_JUNCTIONS`. Gives the same lines as folding the raw output. """
+
+        junctions = {tuple(key.split(' ')): value for key, value in FOLDING_PINGYAM_JUNCTIONS.items()}
+        # Without word boundaries, each word is followed by an empty phoneme, since folding leaves a double space
+        word_end = ['WORD_BOUNDARY'] if self.keep_word_boundaries else ['']
+        phonemized_lines = []
+        for words in self._phonemize_syllables(lines, load_folded_syllable_table(), junctions):
+            if words is None:
+                phonemized_lines.append('')
+            elif not any(words):
+                # Lines of words without phonemes are only spaces or word boundaries, which are left to `fold`
+                phonemized_lines.extend(self.fold([self._serialize(words)]))
+            else:
+                phonemized_lines.append(' '.join(phoneme for word in words for phoneme in word + word_end))
+        return phonemized_lines
+
+    def _phonemize_syllables(self, lines, syllable_table, junctions=None):
+        """ Looks up the syllables of each line in `syllable_table`, returning the words of phonemes of each line (None
+        if a syllable was not found). If `junctions` is given, the last phoneme of a syllable and the first phoneme of
+        the next syllable in the word are replaced by `junctions[(last, first)]`, if present. """
 
         broken = 0
         phonemized_utterances = []
 
-        # Load pingyam database
-        cantonese_dict = pd.read_csv(PINGYAM_PATH, sep='\t', header=None)[[5, 6]]
-        cantonese_dict.columns = ['ipa', 'jyutping']
-        cantonese_dict = cantonese_dict.set_index('jyutping').to_dict()['ipa']
-
-        # Convert jyutping to IPA
+        # Convert jyutping to IPA, one syllable at a time. In the raw table each character is a phoneme, and the
+        # multi-character phonemes are joined by the folding dictionary, which also attaches tone markers to the vowels
         for line in lines:
             if line.strip() == '':
-                phonemized_utterances.append('')
+                phonemized_utterances.append(None)
                 continue
-            phonemized = ''
-            words = line.split(' ')
+            words = []
             line_broken = False
-            for word in words:
-                syllables = re.findall(r'[a-zA-Z]+[0-9]*', word)
-                for syllable in syllables:
-                    if syllable not in cantonese_dict:
-                        if not line_broken:
-                            broken += 1
-                            line_broken = True
+            for word in line.split(' '):
+                phonemes = []
+                for syllable in SYLLABLE_PATTERN.findall(word):
+                    syll = syllable_table.get(syllable)
+                    if syll is None:
+                        line_broken = True
+                    elif junctions is not None and len(phonemes) > 0 and len(syll) > 0 and (phonemes[-1], syll[0]) in junctions:
+                        phonemes[-1] = junctions[(phonemes[-1], syll[0])]
+                        phonemes.extend(syll[1:])
                     else:
-                        syll = cantonese_dict[syllable]
-                        syll = move_tone_marker_to_after_vowel(syll)
-                        phonemized += syll + ''
-                phonemized += '_'
+                        phonemes.extend(syll)
+                words.append(phonemes)
             if line_broken:
-                phonemized = ''
-            phonemized_utterances.append(phonemized)
+                broken += 1
+                phonemized_utterances.append(None)
+            else:
+                phonemized_utterances.append(words)
 
         if broken > 0:
             self.logger.debug(f'WARNING: {broken} lines were not phonemized successfully by jyutping to ipa conversion.')
-        
-        # Separate phonemes with spaces and add word boundaries
-        # The spaces between multi-character phonemes are fixed by the folding dictionary, which
-        # also attaches tone markers to the vowels
-        for i in range(len(phonemized_utterances)):
-            phonemized_utterances[i] = ' '.join(list(phonemized_utterances[i]))
-            phonemized_utterances[i] = phonemized_utterances[i].replace('_', 'WORD_BOUNDARY' if self.keep_word_boundaries else ' ')
-
-        if self.use_folding:
-            phonemized_utterances = self._post_process_pingyam_output(phonemized_utterances)
-        else:
-            self.logger.debug("Skipping folding dictionary post-processing, using uncorrected output from pingyam.")
 
         return phonemized_utterances
 
-    def _post_process_pingyam_output(self, lines):
-        """Corrects output from pinyin_to_ipa library. """
+    def _word_end(self):
+        # Without word boundaries, each word is followed by a space token (two extra spaces)
+        return ['WORD_BOUNDARY'] if self.keep_word_boundaries else [' ']
 
-        for i in range(len(lines)):
-            if lines[i] == '' or lines[i] == ' ':
-                continue
-            for key, value in FOLDING_PINGYAM.items():
-                lines[i] = lines[i].replace(key, value)
+    def _fold(self, lines):
+        """ Corrects output from pingyam, joining multi-character phonemes and attaching tone markers. """
+
+        indices = [i for i in range(len(lines)) if lines[i] != '' and lines[i] != ' ']
+        folded = get_folder(FOLDING_PINGYAM).fold_lines([lines[i] for i in indices])
+        for i, line in zip(indices, folded):
+            lines[i] = line
 
         return lines
\ No newline at end of file
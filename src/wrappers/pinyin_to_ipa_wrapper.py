@@ -1,65 +1,130 @@
 """ Wrapper for pinyin_to_ipa library for converting Mandarin pinyin to IPA. """
 
+import itertools
 import re
+from functools import lru_cache
 
 from pinyin_to_ipa import pinyin_to_ipa
 from ..dicts import FOLDING_PINYIN_TO_IPA
+from ..folding import get_folder
+from .help import PINYIN_TO_IPA_LANGUAGES_MESSAGE
 from .wrapper import Wrapper
 
+# Spellings used to enumerate the pinyin syllable inventory. Not every combination is a valid syllable; those
+# rejected by pinyin_to_ipa are left out of the table. Finals spelled with ê or ü are left out too, since
+# SYLLABLE_PATTERN only matches ASCII letters (ü is written as v).
+INITIALS = ['', 'b', 'p', 'm', 'f', 'd', 't', 'n', 'l', 'g', 'k', 'h', 'j', 'q', 'x', 'zh', 'ch', 'sh', 'r', 'z', 'c', 's', 'y', 'w']
+FINALS = ['a', 'o', 'e', 'i', 'u', 'v', 'ai', 'ei', 'ao', 'ou', 'an', 'en', 'ang', 'eng', 'ong', 'er',
+          'ia', 'ie', 'iao', 'iu', 'ian', 'in', 'iang', 'ing', 'iong', 'io', 'ua', 'uo', 'uai', 'ui', 'uan', 'un',
+          'uang', 'ueng', 'ue', 've', 'van', 'vn', 'm', 'n', 'ng', 'hm', 'hng']
+TONES = ['', '1', '2', '3', '4', '5']
+SYLLABLE_PATTERN = re.compile(r'[a-zA-Z]+[0-9]*')
+
+@lru_cache(maxsize=None)
+def load_syllable_table():
+    """ Transcribes every pinyin syllable (initial, final and tone) with pinyin_to_ipa once per process.
+
+    Returns a dictionary mapping each syllable to a tuple of its phonemes.
+    """
+
+    table = {}
+    for initial, final, tone in itertools.product(INITIALS, FINALS, TONES):
+        syllable = initial + final + tone
+        try:
+            table[syllable] = tuple(pinyin_to_ipa(syllable)[0])
+        except Exception:
+            continue
+    return table
+
+# Syllables missing from the table, transcribed by pinyin_to_ipa on first use (None if it failed)
+_FALLBACK_SYLLABLES = {}
+
+def _transcribe_fallback(syllable):
+    if syllable not in _FALLBACK_SYLLABLES:
+        try:
+            _FALLBACK_SYLLABLES[syllable] = tuple(pinyin_to_ipa(syllable)[0])
+        except Exception:
+            _FALLBACK_SYLLABLES[syllable] = None
+    return _FALLBACK_SYLLABLES[syllable]
+
 class PinyinToIpaWrapper(Wrapper):
 
     SUPPORTED_LANGUAGES = ['mandarin']
+    BACKEND_PACKAGE = 'pinyin-to-ipa'
+
+    def __init__(self, language, keep_word_boundaries=True, verbose=False, use_folding=True, **wrapper_kwargs):
+        super().__init__(language, keep_word_boundaries, verbose, use_folding, **wrapper_kwargs)
+        self.table_coverage = 1.0
 
     @staticmethod
     def supported_languages_message():
-        message = 'The PinyinToIpaWrapper uses the pinyin_to_ipa library, which only supports `mandarin`.\n'
-        return message
+        return PINYIN_TO_IPA_LANGUAGES_MESSAGE
     
-    def phonemize(self, lines):
-        """ Uses pinyin_to_ipa library to convert Mandarin pinyin to IPA. """
+    def folding_dicts(self):
+        return [FOLDING_PINYIN_TO_IPA]
+
+    def _phonemize(self, lines):
+        """ Uses pinyin_to_ipa library to convert Mandarin pinyin to IPA.
+
+        Syllables are looked up in a table built once per process (see `load_syllable_table`), falling back to the
+        library for syllables that are not in the table. The proportion of syllables found in the table is logged
+        and stored in `self.table_coverage`.
+        """
 
         phonemized_utterances = []
         broken = 0
+        syllable_table = load_syllable_table()
+        found = 0
+        missed = 0
         for line in lines:
             if line.strip() == '':
-                phonemized_utterances.append('')
+                phonemized_utterances.append(None)
                 continue
-            phonemized = ""
-            words = line.split(' ')
-            try:
-                for word in words:
-                    syllables = re.findall(r'[a-zA-Z]+[0-9]*', word)
-                    syllables = [re.sub(r'[0]', '', syllable) for syllable in syllables]
-                    for syllable in syllables:
-                        syll_set = pinyin_to_ipa(syllable)
-                        syll = ' '.join(syll_set[0])
-                        phonemized += syll + ' '
-                    if self.keep_word_boundaries:
-                        phonemized += 'WORD_BOUNDARY '
-            except Exception as e:
-                phonemized = ""
+            words = []
+            line_broken = False
+            for word in line.split(' '):
+                phonemes = []
+                for syllable in SYLLABLE_PATTERN.findall(word):
+                    syllable = syllable.replace('0', '')
+                    syll = syllable_table.get(syllable)
+                    if syll is not None:
+                        found += 1
+                    else:
+                        missed += 1
+                        syll = _transcribe_fallback(syllable)
+                        if syll is None:
+                            line_broken = True
+                            break
+                    phonemes.extend(syll)
+                if line_broken:
+                    break
+                words.append(phonemes)
+            if line_broken:
+                words = None
                 broken += 1
 
-            phonemized_utterances.append(phonemized)
+            phonemized_utterances.append(words)
 
+        self.table_coverage = found / (found + missed) if found + missed > 0 else 1.0
+        self.logger.debug(f'Found {found} of {found + missed} syllables in the pinyin table ({self.table_coverage:.1%} coverage).')
         if broken > 0:
             self.logger.debug(f'WARNING: {broken} lines were not phonemized successfully by pinyin to ipa conversion.')
 
-        if self.use_folding:
-            phonemized_utterances = self._post_process_pinyin_to_ipa_output(phonemized_utterances)
-        else:
-            self.logger.debug("Skipping folding dictionary post-processing, using uncorrected output from pinyin_to_ipa.")
-
         return phonemized_utterances
 
-    def _post_process_pinyin_to_ipa_output(self, lines):
+    def _serialize(self, words):
+        # Each phoneme and word boundary is followed by a space
+        if words is None:
+            return ''
+        return ''.join(token + ' ' for token in self._line_tokens(words))
+
+    def _fold(self, lines):
         """Corrects output from pinyin_to_ipa library. """
 
-        for i in range(len(lines)):
-            if lines[i] == '' or lines[i] == ' ':
-                continue
-            for key, value in FOLDING_PINYIN_TO_IPA.items():
-                lines[i] = lines[i].replace(key, value)
+        indices = [i for i in range(len(lines)) if lines[i] != '' and lines[i] != ' ']
+        folded = get_folder(FOLDING_PINYIN_TO_IPA).fold_lines([lines[i] for i in indices])
+        for i, line in zip(indices, folded):
+            lines[i] = line
 
         return lines
 
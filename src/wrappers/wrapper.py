@@ -1,14 +1,36 @@
 """ Abstract base class for wrappers. """
 
 from abc import ABC, abstractmethod
+import hashlib
+import importlib.metadata
+import json
 import logging
+import os
+
+from .help import COMMON_KWARGS_HELP
+from ..utils import file_hash
 
 class Wrapper(ABC):
 
     SUPPORTED_LANGUAGES = []
-    WRAPPER_KWARGS_TYPES = {}
-    WRAPPER_KWARGS_DEFAULTS = {}
-    KWARGS_HELP = {}
+
+    # Name of the package that implements the backend, used to version cached outputs.
+    BACKEND_PACKAGE = None
+
+    # Arguments that only control how the backend is run (e.g. parallelism) and do not change its output.
+    EXECUTION_KWARGS = []
+
+    # Arguments accepted by every wrapper. Subclasses that add their own arguments should extend these dictionaries.
+    WRAPPER_KWARGS_TYPES = {
+        'lexicon_mode': bool,
+    }
+
+    WRAPPER_KWARGS_DEFAULTS = {
+        'lexicon_mode': False,
+    }
+
+    # Help for each argument, shown by `g2pp.py --help`. Kept in help.py so that it can be shown without importing the wrapper.
+    KWARGS_HELP = COMMON_KWARGS_HELP
     
     @staticmethod
     @abstractmethod
@@ -37,6 +59,8 @@ class Wrapper(ABC):
         self.logger = logging.getLogger(f"{__name__}.{self.__class__.__name__}")
         self.logger.setLevel(logging.DEBUG if verbose else logging.INFO)
         self.verbose = verbose
+        self.dedup_ratio = 0.0
+        self.cache = None
         
         self.logger.debug(f'Initializing {self.__class__.__name__} with language "{language}" and wrapper_kwargs "{wrapper_kwargs}"')
 
@@ -56,22 +80,199 @@ class Wrapper(ABC):
             if key not in wrapper_kwargs:
                 setattr(self, key, value)
                 
-    @abstractmethod
     def phonemize(self, lines):
         """ Uses a phonemizer backend to phonemize text. Returns a list of phonemized lines.
-        Lines that could not be phonemized should be returned as empty strings ('').
+        Lines that could not be phonemized are returned as empty strings ('').
+
+        Identical lines are only phonemized once: the unique lines are passed to `_phonemize`, whose words of
+        phonemes are serialized once by `_serialize`, and the results are expanded back to the order and length of
+        `lines`. The fraction of lines that were duplicates is logged and stored in `self.dedup_ratio`. If
+        use_folding is True, the backend's raw output is then corrected with `fold`, or with `_phonemize_folded`
+        when the raw output is not needed (no cache and no lexicon mode).
+        """
+
+        lines = list(lines)
+        unique_lines = list(dict.fromkeys(lines))
+        self.dedup_ratio = 1 - len(unique_lines) / len(lines) if len(lines) > 0 else 0.0
+        self.logger.debug(f'Phonemizing {len(unique_lines)} unique lines out of {len(lines)} ({self.dedup_ratio:.1%} duplicates).')
+
+        if self.use_folding and not self.lexicon_mode and self.cache is None:
+            # The raw output is not stored, so the wrapper may correct the phonemes without serializing them first
+            phonemized_lines = self._phonemize_folded(unique_lines)
+        else:
+            if self.lexicon_mode:
+                phonemized_lines = self._phonemize_lexicon(unique_lines)
+            else:
+                phonemized_lines = self._phonemize_cached(unique_lines)
+            if self.use_folding:
+                phonemized_lines = self.fold(phonemized_lines)
+            else:
+                self.logger.debug(f'Skipping folding dictionary post-processing, using uncorrected output from {self.__class__.__name__}.')
+        if len(unique_lines) == len(lines):
+            return phonemized_lines
+        phonemized = dict(zip(unique_lines, phonemized_lines))
+        return [phonemized[line] for line in lines]
+
+    def _phonemize_lexicon(self, lines):
+        """ Phonemizes lines by phonemizing each word type once and rebuilding each line from the per-word results.
+
+        All word types in `lines` are phonemized as a single batch, one word per line, so that each
+        type is only phonemized once and the backend never has to align words within an utterance. Word boundaries
+        are then placed exactly between the words of the original line. A word that produces no phonemes is
+        dropped if it contains no letters or digits (e.g. standalone punctuation), otherwise the whole line could
+        not be phonemized and is returned as an empty string.
+        """
+
+        words_per_line = [line.split() for line in lines]
+        word_types = list(dict.fromkeys(word for words in words_per_line for word in words))
+        num_tokens = sum(len(words) for words in words_per_line)
+        self.logger.debug(f'Lexicon mode: phonemizing {len(word_types)} word types for {num_tokens} word tokens.')
+
+        # Remove any boundary markers the backend placed, so that each word is a plain list of phonemes
+        lexicon = {}
+        for word, phonemized in zip(word_types, self._phonemize_cached(word_types)):
+            lexicon[word] = [phoneme for phoneme in phonemized.split() if phoneme != 'WORD_BOUNDARY']
+
+        phonemized_lines = []
+        broken = 0
+        for words in words_per_line:
+            tokens = []
+            for word in words:
+                if len(lexicon[word]) > 0:
+                    tokens.extend(lexicon[word])
+                    if self.keep_word_boundaries:
+                        tokens.append('WORD_BOUNDARY')
+                elif any(c.isalnum() for c in word):
+                    tokens = []
+                    broken += 1
+                    break
+            phonemized_lines.append(' '.join(tokens))
+
+        if broken > 0:
+            self.logger.debug(f'{broken} lines contained words that could not be phonemized.')
+
+        return phonemized_lines
+
+    def close(self):
+        """ Releases any resources held by the backend, such as worker processes. The wrapper can still be used afterwards. """
+        pass
+
+    def fold(self, lines):
+        """ Applies the folding dictionaries (and any other corrections, such as moving tone markers) to raw output
+        of the backend, as produced with use_folding=False. Returns a new list of lines.
+
+        This allows output saved with use_folding=False to be corrected again after the folding dictionaries
+        change, without running the backend.
+        """
+        return self._fold(list(lines))
+
+    def _fold(self, lines):
+        """ Corrects raw output of the backend in place, returning `lines`. Wrappers without folding dictionaries return the lines unchanged. """
+        return lines
+
+    def _phonemize_folded(self, lines):
+        """ Phonemizes lines and corrects them with the folding dictionaries, giving the same lines as `fold` applied
+        to the raw output. Wrappers that can correct the words of phonemes directly override this. """
+        return self.fold(self._phonemize_raw(lines))
+
+    def _phonemize_cached(self, lines):
+        """ Calls `_phonemize_raw` on the lines that are not found in `self.cache`, storing the new outputs. If no cache is set, calls `_phonemize_raw` directly. """
+
+        if self.cache is None:
+            return self._phonemize_raw(lines)
+
+        phonemized = self.cache.get_many(lines)
+        missing = [line for line in lines if line not in phonemized]
+        self.logger.debug(f'Pronunciation cache: {len(lines) - len(missing)} hits, {len(missing)} misses.')
+        if len(missing) > 0:
+            missing_phonemized = self._phonemize_raw(missing)
+            self.cache.put_many(zip(missing, missing_phonemized))
+            phonemized.update(zip(missing, missing_phonemized))
+        return [phonemized[line] for line in lines]
+
+    def backend_version(self):
+        """ Returns the version of the library used by the backend, or None if it is not known. """
+
+        if self.BACKEND_PACKAGE is None:
+            return None
+        try:
+            return importlib.metadata.version(self.BACKEND_PACKAGE)
+        except importlib.metadata.PackageNotFoundError:
+            return None
+
+    def folding_dicts(self):
+        """ Returns the folding dictionaries applied to the wrapper's output. """
+        return []
+
+    def data_files(self):
+        """ Returns the paths of the data files (such as dictionaries) that the raw output of the backend depends on. """
+        return []
+
+    def cache_namespace(self):
+        """ Returns a key identifying everything the raw output of the backend depends on: the wrapper and its
+        arguments, the version of the backend library and the contents of its data files. Folding is applied after
+        the cache, so editing the folding dictionaries does not invalidate cached outputs. """
+
+        config = {
+            'wrapper': self.__class__.__name__,
+            'language': self.language,
+            'keep_word_boundaries': self.keep_word_boundaries,
+            'wrapper_kwargs': {key: getattr(self, key) for key in self.WRAPPER_KWARGS_TYPES if key not in self.EXECUTION_KWARGS},
+            'backend_version': self.backend_version(),
+            'data_files': [file_hash(path) if os.path.exists(path) else None for path in self.data_files()],
+        }
+        return hashlib.sha256(json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @abstractmethod
+    def _phonemize(self, lines):
+        """ Uses a phonemizer backend to phonemize text. Returns a list the same length as `lines`, where each line is
+        a list of words and each word is a list of IPA phonemes. Lines that could not be phonemized should be None.
+
+        The output is the raw output of the backend, before it is serialized by `_serialize` and the folding
+        dictionaries are applied by `_fold`. Word boundaries are not part of the words; they are added by `_serialize`.
+
+        Example:
+        Input: ['hello there!']
+        Output: [[['h', 'ə', 'l', 'oʊ'], ['ð', 'ɛ', 'ɹ']]]
+        """
+        pass
+
+    def _word_end(self):
+        """ Returns the tokens placed after the phonemes of each word when a line is serialized. """
+        return ['WORD_BOUNDARY'] if self.keep_word_boundaries else []
+
+    def _line_tokens(self, words):
+        """ Returns the phonemes of the words of a line, with the tokens of `_word_end` after each word. """
+
+        tokens = []
+        word_end = self._word_end()
+        for word in words:
+            tokens.extend(word)
+            tokens.extend(word_end)
+        return tokens
+
+    def _serialize(self, words):
+        """ Serializes a line phonemized by `_phonemize` to the raw output of the wrapper, which is stored by the
+        pronunciation cache and corrected by `fold`. Lines that could not be phonemized (None) are returned as empty strings.
         
-        All wrappers should output IPA phonemes separated by spaces. If keep_word_boundaries is True, they should also output 'WORD_BOUNDARY' at the end of each word:
+        All wrappers output IPA phonemes separated by spaces. If keep_word_boundaries is True, they also output 'WORD_BOUNDARY' at the end of each word:
 
         Example 1 (keep_word_boundaries=True):
-        Input: 'hello there!'
+        Input: [['h', 'ə', 'l', 'oʊ'], ['ð', 'ɛ', 'ɹ']]
         Output: 'h ə l oʊ WORD_BOUNDARY ð ɛ ɹ WORD_BOUNDARY'
 
         Example 2 (keep_word_boundaries=False):
-        Input: 'hello there!'
+        Input: [['h', 'ə', 'l', 'oʊ'], ['ð', 'ɛ', 'ɹ']]
         Output: 'h ə l oʊ ð ɛ ɹ'
         """
-        pass
+
+        if words is None:
+            return ''
+        return ' '.join(self._line_tokens(words))
+
+    def _phonemize_raw(self, lines):
+        """ Phonemizes lines with `_phonemize`, returning the serialized raw output of each line. """
+        return [self._serialize(words) for words in self._phonemize(lines)]
 
     def check_language_support(self, language):
         """ Checks if the language is supported by the wrapper. 
@@ -84,8 +285,13 @@ class Wrapper(ABC):
             return True
         return False
 
+    @classmethod
+    def list_languages(cls):
+        """ Returns a list of supported languages by the wrapper, without constructing it. """
+        return list(cls.SUPPORTED_LANGUAGES)
+
     def get_supported_languages(self):
         """ Returns a list of supported languages by the wrapper. """
-        return self.SUPPORTED_LANGUAGES
+        return self.list_languages()
 
     
@@ -0,0 +1,74 @@
+""" Differential tests of the compiled folding dictionaries against applying each rule in order with `str.replace`. """
+
+import random
+
+import pytest
+
+from src import dicts
+from src.folding import Folder
+
+def _folding_dicts():
+    """ Returns (name, folding) for every folding dictionary in dicts.py, including each language of the nested ones. """
+
+    foldings = []
+    for name, value in vars(dicts).items():
+        if not name.startswith('FOLDING_'):
+            continue
+        if all(isinstance(folding, dict) for folding in value.values()):
+            foldings.extend((f'{name}[{language}]', folding) for language, folding in value.items())
+        else:
+            foldings.append((name, value))
+    return foldings
+
+FOLDINGS = _folding_dicts()
+
+def _replace_chain(folding, line, pad=False):
+    """ The reference implementation: each rule applied in order with `str.replace`. """
+
+    if pad:
+        line = ' ' + line + ' '
+    for key, value in folding.items():
+        line = line.replace(key, value)
+    return line.strip() if pad else line
+
+def _random_lines(folding, num_lines, seed):
+    """ Returns lines made of the keys and values of a folding dictionary (and of their characters), joined with
+    and without spaces, so that rules match, overlap and create new matches for later rules. """
+
+    rng = random.Random(seed)
+    pieces = [piece for key, value in folding.items() for piece in (key, value) if piece != '']
+    pieces += sorted({char for piece in pieces for char in piece})
+    pieces += ['WORD_BOUNDARY', 'a', 'ə']
+    lines = []
+    for _ in range(num_lines):
+        parts = [rng.choice(pieces) for _ in range(rng.randint(0, 12))]
+        line = ''
+        for part in parts:
+            line += rng.choice(['', ' ', ' ']) + part
+        lines.append(line)
+    return lines
+
+@pytest.mark.parametrize('name, folding', FOLDINGS, ids=[name for name, _ in FOLDINGS])
+@pytest.mark.parametrize('pad', [False, True])
+def test_fold_lines_matches_replace_chain(name, folding, pad):
+    folder = Folder(folding)
+    lines = _random_lines(folding, 500, seed=name)
+    expected = [_replace_chain(folding, line, pad) for line in lines]
+
+    # A whole batch at once, and one line at a time
+    assert folder.fold_lines(lines, pad=pad) == expected
+    assert [folder.fold_lines([line], pad=pad)[0] for line in lines[:100]] == expected[:100]
+
+@pytest.mark.parametrize('name, folding', FOLDINGS, ids=[name for name, _ in FOLDINGS])
+@pytest.mark.parametrize('pad', [False, True])
+def test_fold_lines_with_newlines(name, folding, pad):
+    folder = Folder(folding)
+    lines = _random_lines(folding, 100, seed=name + '\n')
+    # Lines that contain newlines cannot be folded as one newline-joined batch
+    lines = [line.replace(' ', '\n', 1) for line in lines] + ['', ' ', '\n']
+    expected = [_replace_chain(folding, line, pad) for line in lines]
+    assert folder.fold_lines(lines, pad=pad) == expected
+
+@pytest.mark.parametrize('pad', [False, True])
+def test_fold_lines_empty_batch(pad):
+    assert Folder(dicts.FOLDING_PINGYAM).fold_lines([], pad=pad) == []